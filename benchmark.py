@@ -0,0 +1,286 @@
+'''
+    Throughput benchmarks for the collator, run against synthetic volumes (see
+    synthetic.py) so the numbers are repeatable from one run to the next.
+
+    Each stage is timed on its own -- bigram indexing and Dice comparisons,
+    segment() and its gap filling, correctsequence(), removeheader() and
+    collate() -- at several volume sizes, so regressions show up in the stage
+    that caused them and it is easy to see how each stage scales. An end-to-end bigcollate() run over a
+    small synthetic pairtree rounds it off, written once into the pairtree and once into a
+    shard store.
+
+    The collator modules use relative imports, so run this as a module of the
+    package (python -m <package>.benchmark) from the directory above it.
+'''
+
+import contextlib
+import copy
+import io
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import time
+from operator import itemgetter
+
+from . import collator3
+from .bigcollate import bigcollate
+from .shardstore import ShardStore
+from .synthetic import buildcollection, ocrnoise, syntheticvolume
+
+
+def timeit(function, repeat=3, setup=None):
+    '''
+    Calls function repeat times and returns (best, median) wall time in seconds.
+    If setup is given it is called, untimed, before each run and its result is
+    passed to function; use it for anything function consumes, like pages that
+    get modified in place.
+    '''
+    times = []
+    for _ in range(repeat):
+        if setup is None:
+            start = time.perf_counter()
+            function()
+        else:
+            argument = setup()
+            start = time.perf_counter()
+            function(argument)
+        times.append(time.perf_counter() - start)
+    return min(times), statistics.median(times)
+
+def headersequence(pageheaders):
+    '''Header candidates ordered by frequency, as collator3 builds them.'''
+    headerdict = {}
+    for header in pageheaders:
+        headerdict[header] = headerdict.get(header, 0) + 1
+    return sorted(headerdict.items(), key = itemgetter(1), reverse = True)
+
+def benchbigrams(repeat, count=400, seed=0):
+    rng = random.Random(seed)
+    headers = [ocrnoise('proceedings of the natural history society', rng, 0.1)
+               for _ in range(count)]
+    results = []
+
+    best, median = timeit(lambda: [collator3.getbigrams(header) for header in headers], repeat)
+    results.append(('getbigrams', count, best, median))
+
+    def encodeall():
+        collator3.encodebigrams.cache_clear()
+        return [collator3.encodebigrams(header) for header in headers]
+    best, median = timeit(encodeall, repeat)
+    results.append(('encodebigrams', count, best, median))
+
+    for name, bigramdexes in (('dicecoefficient (sets)', [collator3.getbigrams(header)
+                                                         for header in headers]),
+                              ('dicecoefficient (bitsets)', encodeall())):
+        def compareall():
+            first = bigramdexes[0]
+            for other in bigramdexes:
+                collator3.dicecoefficient(first, other)
+        best, median = timeit(compareall, repeat)
+        results.append((name, count, best, median))
+    return results
+
+def benchvolume(size, repeat, seed=0):
+    '''Times each collation stage on one synthetic volume of size pages.'''
+    volume = syntheticvolume(seed, pages=size, noise=0.05)
+    pagetable = collator3.PageTable(volume)
+    sequence = headersequence(pagetable.headers)
+    results = []
+
+    best, median = timeit(lambda: collator3.PageTable(volume), repeat)
+    results.append(('pagetable', size, best, median))
+
+    def segmentonce():
+        return collator3.segment(sequence, None, pagetable.headers, pagetable.wordcounts)
+    best, median = timeit(segmentonce, repeat)
+    results.append(('segment', size, best, median))
+
+    sectionruns, headerdict, metadata = segmentonce()
+    best, median = timeit(lambda: collator3.correctsequence(
+                            sectionruns, metadata, None, pagetable.wordcounts), repeat)
+    results.append(('correctsequence', size, best, median))
+
+    divplace, remove, metadata, wc = collator3.plancollation(pagetable)
+    best, median = timeit(lambda pages: [collator3.removeheader(remove, page) for page in pages],
+                          repeat, setup = lambda: copy.deepcopy(volume))
+    results.append(('removeheader', size, best, median))
+
+    best, median = timeit(collator3.collate, repeat, setup = lambda: copy.deepcopy(volume))
+    results.append(('collate', size, best, median))
+
+    return results
+
+def legacyfillgaps(sectioncodes):
+    '''
+    The gap-filling loop segment() ran before collator3.fillgaps(), kept so
+    the two can be timed against each other. Its unreachable tie-break is
+    left out.
+    '''
+    lastsection = 0
+    lastknowndex = 0
+    for idx,page in enumerate(sectioncodes):
+        if page != 999:
+            lastsection = page
+            lastknowndex = idx
+        elif idx == 0:
+            for replace in sectioncodes:
+                if replace != 999:
+                    sectioncodes[idx] = replace
+                    lastknowndex = idx
+                    break
+        elif idx == len(sectioncodes) - 1:
+            sectioncodes[idx] = sectioncodes[idx - 1]
+        else:
+            count = 0
+            for replace in sectioncodes[idx:]:
+                count += 1
+                if replace != 999:
+                    break
+            if (idx - lastknowndex) > count:
+                sectioncodes[idx] = sectioncodes[idx + count]
+                lastsection = page
+                lastknowndex = idx
+            else:
+                sectioncodes[idx] = lastsection
+                lastknowndex = idx
+    return sectioncodes
+
+def benchfillgaps(size, repeat, seed=0):
+    '''
+    Times collator3.fillgaps() against the old loop on size pages of section
+    codes with long unassigned (999) stretches, and checks they agree.
+    '''
+    rng = random.Random(seed)
+    codes = []
+    while len(codes) < size:
+        if rng.random() < 0.5:
+            codes.extend([999] * rng.randint(1, size // 4 + 1))
+        else:
+            codes.extend([rng.randrange(8)] * rng.randint(1, 40))
+    codes = codes[:size]
+    if legacyfillgaps(list(codes)) != collator3.fillgaps(list(codes)):
+        raise AssertionError("fillgaps() disagrees with the old loop")
+
+    results = []
+    best, median = timeit(legacyfillgaps, repeat, setup = lambda: list(codes))
+    results.append(('fillgaps (old loop)', size, best, median))
+    best, median = timeit(collator3.fillgaps, repeat, setup = lambda: list(codes))
+    results.append(('fillgaps', size, best, median))
+    return results
+
+def headerless(volume):
+    '''Whether the full scan finds volume to have no running headers.'''
+    headers = collator3.PageTable(volume).headers
+    return len(headers) / len(set(headers)) <= collator3.header_cutoff
+
+def benchsample(volumes, repeat, seed=0):
+    '''
+    Times collate() with and without the sampled header-less fast path over
+    a mix of synthetic volumes, with and without running headers and at
+    several noise levels, and checks that the two agree. Returns the
+    timings and an agreement report: how many volumes took the fast path,
+    how many of those the full scan also finds header-less, and how many
+    come out exactly as from the full scan (all of them, if it is right).
+    '''
+    rng = random.Random(seed)
+    corpus = [syntheticvolume(rng.randrange(1 << 30), pages=rng.randint(150, 1200),
+                              headers=rng.random() < 0.5, noise=rng.choice((0, 0.05, 0.15, 0.3)))
+              for _ in range(volumes)]
+
+    sampled = agreed = identical = 0
+    for volume in corpus:
+        if collator3.sampleplan(volume)[0] is None:
+            continue
+        sampled += 1
+        agreed += headerless(volume)
+        identical += (collator3.collate(copy.deepcopy(volume))
+                      == collator3.collate(copy.deepcopy(volume), sample=True))
+
+    results = []
+    for name, sample in (('collate (full scan)', False), ('collate sample=True', True)):
+        best, median = timeit(lambda pages: [collator3.collate(volume, sample=sample)
+                                             for volume in pages],
+                              repeat, setup = lambda: copy.deepcopy(corpus))
+        results.append((name, volumes, best, median))
+
+    report = ("header-less fast path: {} of {} volumes sampled, {} of them header-less in the "
+              "full scan, {} with identical output".format(sampled, volumes, agreed, identical))
+    return results, report
+
+def benchbigcollate(volumes, repeat, workers=None, seed=0):
+    '''Times bigcollate() end to end over a synthetic pairtree.'''
+    rootpath = tempfile.mkdtemp(prefix='collatebench') + '/'
+    results = []
+    try:
+        HTids = buildcollection(rootpath, volumes, seed=seed, pages=(50, 400))
+        for poolsize in sorted({1, workers or os.cpu_count() or 1}):
+            def run():
+                with contextlib.redirect_stdout(io.StringIO()):
+                    bigcollate(HTids, rootpath, rewrite_existing=True, workers=poolsize)
+            best, median = timeit(run, repeat)
+            results.append(('bigcollate workers={}'.format(poolsize), volumes, best, median))
+    finally:
+        shutil.rmtree(rootpath, ignore_errors=True)
+    return results
+
+def benchshards(volumes, repeat, workers=None, seed=0):
+    '''
+    Times a pooled bigcollate() run into a ShardStore, with chunksize=1 so
+    every volume is a job of its own, and checks that the workers share out
+    no more shards than there are workers. Returns the timings and a report.
+    '''
+    rootpath = tempfile.mkdtemp(prefix='collatebench') + '/'
+    poolsize = max(workers or os.cpu_count() or 1, 2)
+    try:
+        HTids = buildcollection(rootpath, volumes, seed=seed, pages=(50, 400))
+        def setup():
+            shutil.rmtree(rootpath + 'shards', ignore_errors=True)
+            return ShardStore(rootpath + 'shards')
+        def run(store):
+            with contextlib.redirect_stdout(io.StringIO()):
+                bigcollate(HTids, rootpath, workers=poolsize, chunksize=1, shards=store)
+        best, median = timeit(run, repeat, setup)
+        with ShardStore(rootpath + 'shards') as store:
+            stored, shards = len(store.htids()), len(store.shards())
+    finally:
+        shutil.rmtree(rootpath, ignore_errors=True)
+    report = "shard store: {} of {} volumes in {} shards from {} workers{}".format(
+                stored, volumes, shards, poolsize,
+                '' if shards <= poolsize else " -- MORE SHARDS THAN WORKERS")
+    return [('bigcollate shards workers={}'.format(poolsize), volumes, best, median)], report
+
+def runbenchmarks(sizes=(50, 200, 800, 3200), repeat=3, volumes=20, workers=None):
+    '''
+    Runs every benchmark, prints a table and returns the results as a list of
+    (benchmark, size, best seconds, median seconds) tuples. size is the number
+    of headers for the bigram benchmarks, pages for the per-volume stages and
+    volumes for bigcollate and the header-less fast path, whose agreement
+    with the full scan is printed under the table along with the shard
+    count of a pooled run into a shard store.
+    '''
+    results = benchbigrams(repeat)
+    for size in sizes:
+        results.extend(benchvolume(size, repeat))
+    for size in sizes:
+        results.extend(benchfillgaps(size, repeat))
+    report = None
+    if volumes:
+        sampling, report = benchsample(volumes, repeat)
+        results.extend(sampling)
+        results.extend(benchbigcollate(volumes, repeat, workers))
+        sharding, shardreport = benchshards(volumes, repeat, workers)
+        results.extend(sharding)
+        report += "\n" + shardreport
+
+    print("{:<28}{:>8}{:>12}{:>12}".format('benchmark', 'size', 'best ms', 'median ms'))
+    for name, size, best, median in results:
+        print("{:<28}{:>8}{:>12.2f}{:>12.2f}".format(name, size, best * 1000, median * 1000))
+    if report is not None:
+        print(report)
+    return results
+
+
+if __name__ == "__main__":
+    runbenchmarks()
@@ -1,92 +1,824 @@
-
+import argparse
+import os
+from array import array
+from functools import partial
 from glob import glob
-from zipfile import ZipFile
-
-from .filekeeping import pairtreepath
-from .collator3 import collate
-
-
-def bigcollate(ids_to_process, collectiondir, rewrite_existing=False, 
-                include_divs=True, skip=0):
-    count = 0 ###<<<<<<<<
-    for HTid in ids_to_process:
-        count += 1
-        
-        ## To skip large sections of the HTid list, uncomment and provide a count number
-        if count < skip:
-            print("{}: Skipping.".format(count))
-            continue
-        
-        path, postfix = pairtreepath(HTid, collectiondir)
-        pagepath = path + postfix + "/"
-        filename = postfix + ".zip"
-
-        if not rewrite_existing:                        ## mhhh mhhh meh. Not elegant. Fix this.
-            if len(glob(pagepath + postfix + "*.txt")) > 0: # and len(glob(pagepath + postfix + "*.meta")) > 0:
-                print(str(count) + ": " + HTid + " written during previous session. Skipping.")
+from hashlib import sha1
+from itertools import islice
+from multiprocessing import Pool
+
+from .filekeeping import PairtreeIndex, pairtreepath
+from .headercache import HeaderClusterCache
+from .collator3 import HeaderIndex, collate, pagetext, stage, streamcollate
+from .manifest import Manifest
+from .outputwriter import AtomicWriter, atomicwrite, compressedpath, compressions
+from .pagesource import VolumeSource
+from .pipeline import Pipeline
+from .resultcache import ResultCache, settingskey
+from .sectiondb import SectionDatabase, metasections
+from .shardstore import ShardStore
+from .timing import StageTimer, TimingLog, readlog
+from .watchdog import Quarantine, Watchdog, describe, failurereason
+
+
+def writemeta(metapath, HTid, numberofdivs, metatable, wc, pagecount):
+    '''
+    Creates a metadata file from the collator's section divisions.  The metadata is output as
+    section #, running header pair in section, section wordcount, first page of section, last page
+    of section (as index numbers).  Fields are tab delimited, with the pair of running headers
+    delimited with a semi-colon.
+
+    For files without running headers, a blank set is written.
+    '''
+    atomicwrite(metapath, metatext(HTid, numberofdivs, metatable, wc, pagecount).encode('utf-8'))
+
+
+def metatext(HTid, numberofdivs, metatable, wc, pagecount):
+    '''Returns the contents of the metadata file that writemeta() writes.'''
+    lines = [HTid + "\t" + str(numberofdivs) + "\t" + str(wc)]
+    if metatable == list() or numberofdivs == 1:
+        lines.append("0\tfulltext\t0\t" + str(pagecount - 1) + "\t" + str(wc))
+    else:
+        for idx,entry in enumerate(metatable):
+            lines.append(str(idx) + "\t" + str(entry[0]) + "\t" + str(entry[1]) + "\t" + str(entry[2][0]) + "\t" + str(entry[2][1]))
+    ## The file has no newline at the end.
+    return "\n".join(lines)
+
+
+def sectionrows(numberofdivs, metatable, wc, pagecount):
+    '''
+    Returns the sections metatext() writes as (headers, wordcount, firstpage,
+    lastpage) tuples, as sectiondb.metasections() reads them back.
+    '''
+    if metatable == list() or numberofdivs == 1:
+        return [('fulltext', wc, 0, pagecount - 1)]
+    return [(str(entry[0]), entry[1], entry[2][0], entry[2][1]) for entry in metatable]
+
+
+def writetext(textpath, pages, compression=None):
+    '''
+    Writes collated pages to textpath in a single writelines() call, through a
+    temporary file that is renamed into place once the volume is complete.
+    compression is None, 'gzip' or 'lzma' (see outputwriter). Returns the
+    number of pages written and a SHA-1 checksum of the uncompressed text
+    (UTF-8 encoded) for the run manifest.
+    '''
+    pagecount = 0
+    checksum = sha1()
+
+    def encoded():
+        nonlocal pagecount
+        for page in pages:
+            pagecount += 1
+            data = pagetext(page).encode('utf-8')
+            checksum.update(data)
+            yield data
+
+    with AtomicWriter(textpath, compression) as file:
+        file.writelines(encoded())
+    return pagecount, checksum.hexdigest()
+
+
+def packpages(pages):
+    '''
+    Encodes collated pages for a ShardStore. Returns the volume as UTF-8
+    bytes, the byte offset at which each page starts, and a SHA-1 checksum
+    of the text as writetext() computes it.
+    '''
+    checksum = sha1()
+    chunks = []
+    offsets = array('Q')
+    size = 0
+    for page in pages:
+        offsets.append(size)
+        data = pagetext(page).encode('utf-8')
+        checksum.update(data)
+        chunks.append(data)
+        size += len(data)
+    return b''.join(chunks), offsets, checksum.hexdigest()
+
+
+def sectionstarts(numberofdivs, metatable):
+    '''Returns the page on which each section written to the .meta begins.'''
+    if metatable == list() or numberofdivs == 1:
+        return [0]
+    return [entry[2][0] for entry in metatable]
+
+
+def volumepaths(HTid, collectiondir, location=None):
+    '''
+    Returns the pairtree directory of HTid (with a trailing slash), the stem
+    its output files are named with, and the path of its zip. When
+    collectiondir is None, location is the (zip path, size, mtime) entry of
+    HTid in a PairtreeIndex.
+    '''
+    if collectiondir is None:
+        zippath = location[0]
+        pagepath, filename = os.path.split(zippath)
+        return pagepath + "/", filename[:-len(".zip")], zippath
+    path, postfix = pairtreepath(HTid, collectiondir)
+    pagepath = path + postfix + "/"
+    return pagepath, postfix, pagepath + postfix + ".zip"
+
+
+def outputexists(HTid, pagepath, postfix, compression=None, shards=None, written=None):
+    '''
+    Checks whether HTid was already collated, into shards if given. written
+    is what a PairtreeIndex recorded about the volume's .txt (see
+    PairtreeIndex.hasoutput); when it is known the pairtree isn't probed.
+    '''
+    if shards is not None:
+        return HTid in shards
+    if written is not None:
+        return written
+    ## mhhh mhhh meh. Not elegant. Fix this.
+    return len(glob(pagepath + postfix + "*.txt" + compressions[compression])) > 0 # and len(glob(pagepath + postfix + "*.meta")) > 0:
+
+
+def prefetchvolume(HTid, collectiondir, rewrite_existing=False, compression=None,
+                    shards=None, location=None, written=None, expected=None, **settings):
+    '''
+    Reads the zip of HTid ahead of collatevolume(), which takes the same
+    arguments, for a pipelined run. Returns the (zip bytes, size, mtime)
+    that collatevolume() takes as prefetched, or None for a volume it will
+    skip without reading or report as missing.
+
+    Shard stores are not checked here, since their index connection belongs
+    to the collating thread.
+    '''
+    if collectiondir is None and location is None:
+        return None
+    pagepath, postfix, zippath = volumepaths(HTid, collectiondir, location)
+    if not rewrite_existing and shards is None and outputexists(HTid, pagepath, postfix,
+                                                                compression, written=written):
+        return None
+    try:
+        with open(zippath, mode='rb') as file:
+            if collectiondir is None:
+                zipsize, zipmtime = location[1:]
+            else:
+                zipstat = os.fstat(file.fileno())
+                zipsize, zipmtime = zipstat.st_size, zipstat.st_mtime
+            if expected is not None and tuple(expected) == (zipsize, zipmtime):
+                return None
+            return file.read(), zipsize, zipmtime
+    except OSError:
+        return None
+
+
+def collatevolume(HTid, collectiondir, rewrite_existing=False, include_divs=True,
+                    stream=False, expected=None, cache=None, timed=False, compression=None,
+                    shards=None, sections=False, location=None, headercache=None,
+                    serial=None, prefetched=None, writer=None, errors='strict', timer=None,
+                    written=None):
+    '''
+    Reads, collates and writes a single volume. Returns a (status, message, info)
+    triple so the caller can report progress; status is one of 'done', 'exists'
+    or 'missing', and info holds the zip's size and mtime and the checksum of
+    the collated text for the run manifest. Nothing is printed here, which lets
+    the function run in a worker process while the parent keeps the progress
+    log in order.
+
+    With stream=True the volume is collated in two passes over the zip (see
+    collator3.streamcollate), so only one page is held in memory at a time.
+    expected is the (size, mtime) the zip had when it was last collated; if the
+    zip still matches, the volume is skipped. cache is an optional ResultCache;
+    on a hit the stored output is copied into place instead of collating.
+    With timed=True, info['timing'] holds a per-stage timing record (see
+    timing.StageTimer). compression ('gzip' or 'lzma') compresses the .txt,
+    which is then written as .txt.gz or .txt.xz. shards is an optional
+    ShardStore; the volume is appended to it instead of being written into
+    the pairtree. With sections=True, info['sections'] holds the volume's
+    section table as (numberofdivs, wordcount, pagecount, sections) for a
+    SectionDatabase.
+
+    When collectiondir is None, the volume was looked up in a PairtreeIndex
+    and location is its (zip path, size, mtime) entry there, or None if the
+    index doesn't have it. written is then whether the index found the
+    volume's .txt, which saves looking for it (None if it doesn't know).
+
+    headercache is an optional HeaderClusterCache and serial the serial (or
+    record) id of the volume. segment() is then seeded with the running
+    headers already known for the serial, and what it finds goes back into
+    the cache.
+
+    prefetched is the (zip bytes, size, mtime) of the volume when it has
+    already been read (see prefetchvolume), and writer an optional
+    pipeline.PendingWrites. The .txt and .meta are then handed to the writer
+    instead of being written here, and so is storing them in the cache;
+    volumes going into shards are still appended here.
+
+    errors is passed to bytes.decode() for every page ('replace' is what
+    fixzip.py does). timer is a StageTimer to time the volume with, in place
+    of the one timed=True makes; a watchdog passes its own, to learn which
+    stage a failed volume was in.
+    '''
+    if timer is None and timed:
+        timer = StageTimer()
+
+    if collectiondir is None and location is None:
+        return 'missing', "{} error: not in pairtree index".format(HTid), {}
+    pagepath, postfix, zippath = volumepaths(HTid, collectiondir, location)
+    textpath = compressedpath(pagepath + postfix + ".txt", compression)
+    metapath = pagepath + postfix + ".meta"
+
+    if not rewrite_existing and outputexists(HTid, pagepath, postfix, compression, shards,
+                                             written):
+        if shards is not None:
+            return 'exists', HTid + " already in shard store. Skipping.", {}
+        return 'exists', HTid + " written during previous session. Skipping.", {}
+
+    # For each HTid, we get a path in the pairtree structure.
+    # Then we read page files, and concatenate them in a list of pages
+    # where each page is a list of lines.
+
+    try:
+        if prefetched is not None:
+            zipdata, zipsize, zipmtime = prefetched
+        elif collectiondir is not None:
+            zipstat = os.stat(zippath)
+            zipsize, zipmtime = zipstat.st_size, zipstat.st_mtime
+        else:
+            zippath, zipsize, zipmtime = location
+        info = {'zipsize': zipsize, 'zipmtime': zipmtime}
+        if expected is not None and tuple(expected) == (zipsize, zipmtime):
+            return 'exists', HTid + " unchanged since previous session. Skipping.", info
+        if prefetched is not None:
+            pass
+        elif cache is None:
+            source = VolumeSource(zippath, errors, timer=timer, compact=not stream)
+        else:
+            with stage(timer, 'read'):
+                with open(zippath, mode='rb') as file:
+                    zipdata = file.read()
+    except FileNotFoundError:
+        return 'missing', "{} error: file not found".format(HTid), {}
+
+    if prefetched is not None and cache is None:
+        source = VolumeSource(zipdata, errors, timer=timer, compact=not stream)
+        del zipdata
+
+    headerindex = None
+    seeds = None
+    if headercache is not None and serial is not None:
+        with stage(timer, 'headercache'):
+            seeds = headercache.headers(serial)
+            headerindex = HeaderIndex(seeds)
+
+    if cache is not None:
+        ## The zip has already been read to hash it, so a miss collates
+        ## straight from the bytes in memory.
+        with stage(timer, 'cache'):
+            cachekey = cache.key(zipdata, HTid, settingskey(include_divs, compression=compression,
+                                                            seeds=seeds))
+            checksum = cache.fetch(cachekey, textpath, metapath)
+        if checksum is not None:
+            info['checksum'] = checksum
+            if sections and include_divs:
+                with stage(timer, 'sections'):
+                    with open(metapath, encoding='utf-8') as file:
+                        numberofdivs, wc, table = metasections(file.read())
+                ## Every section table runs to the last page of the volume.
+                info['sections'] = (numberofdivs, wc, table[-1][3] + 1, table)
+            if timer is not None:
+                info['timing'] = timer.record(htid=HTid, status='cached')
+            return 'done', HTid + " restored from cache.", info
+        source = VolumeSource(zipdata, errors, timer=timer, compact=not stream)
+        del zipdata
+
+    ## Here is where all the collating magic happens. Repeated page headers
+    ## are removed, and used to divde the document into <div>s.
+
+    with source:
+        pagecount = len(source)
+        if stream:
+            ## The first pass only needs header candidates and word counts,
+            ## which the source can get without decoding whole pages.
+            with stage(timer, 'headers'):
+                pagetable = source.pagetable()
+            pages, numberofdivs, metatable, wc = streamcollate(source.pages,
+                                                        include_divs=include_divs, timer=timer,
+                                                        pagetable=pagetable,
+                                                        headerindex=headerindex)
+            del pagetable
+        else:
+            ## The whole volume is held in memory here, so the source decodes
+            ## each page as a compact collator3.Page.
+            pagelist = list(source.pages())
+            pages, numberofdivs, metatable, wc = collate(pagelist,
+                                                        include_divs=include_divs, timer=timer,
+                                                        headerindex=headerindex)
+
+        if sections:
+            with stage(timer, 'sections'):
+                info['sections'] = (numberofdivs, wc, pagecount,
+                                    sectionrows(numberofdivs, metatable, wc, pagecount))
+
+        ## The .txt is what marks a volume as finished (see outputexists), so
+        ## it is written after the .meta, here and in the writer thread alike.
+        with stage(timer, 'write'):
+            meta = None
+            if include_divs:
+                meta = metatext(HTid, numberofdivs, metatable, wc, pagecount)
+            if shards is not None:
+                data, offsets, info['checksum'] = packpages(pages)
+                ## Section offsets point at the page that opens each <div>.
+                divs = [offsets[page] if page < pagecount else len(data)
+                        for page in sectionstarts(numberofdivs, metatable)]
+                shards.append(HTid, data, divs, meta)
+            elif writer is not None:
+                if meta is not None:
+                    writer.write(metapath, meta.encode('utf-8'))
+                data, offsets, info['checksum'] = packpages(pages)
+                writer.write(textpath, data, compression)
+                del data
+            else:
+                if meta is not None:
+                    atomicwrite(metapath, meta.encode('utf-8'))
+                info['checksum'] = writetext(textpath, pages, compression)[1]
+
+    if headerindex is not None:
+        with stage(timer, 'headercache'):
+            headercache.update(serial, headerindex, len(seeds))
+
+    if cache is not None and writer is not None:
+        ## The cache copies the output files, so it has to wait for them.
+        writer.after(partial(cache.store, cachekey, textpath,
+                             metapath if include_divs else None, info['checksum']))
+    elif cache is not None:
+        with stage(timer, 'cache'):
+            cache.store(cachekey, textpath, metapath if include_divs else None,
+                        info['checksum'])
+
+    if timer is not None:
+        info['timing'] = timer.record(htid=HTid, status='done', divs=numberofdivs)
+
+    return 'done', HTid, info
+
+
+def _collatejob(job, prefetched=None, writer=None):
+    ## Pool.imap only passes a single argument, so the job is a tuple of the
+    ## HTid and the keyword arguments for collatevolume(). Volumes the manifest
+    ## already lists as done come through with no arguments at all.
+    HTid, settings = job
+    if settings is None:
+        return HTid, 'exists', HTid + " completed in manifest. Skipping.", {}
+    if 'watchdog' in settings:
+        return _watchedjob(HTid, settings, prefetched, writer)
+    try:
+        return (HTid,) + collatevolume(HTid, prefetched=prefetched, writer=writer, **settings)
+    except Exception as err:
+        return HTid, 'failed', "{} error: {!r}".format(HTid, err), {}
+
+
+def _watchedjob(HTid, settings, prefetched=None, writer=None):
+    ## A volume that fails under the watchdog is quarantined and collated
+    ## again with errors='replace'. The retry starts outside the except
+    ## block, so the first attempt's pages can be freed with its traceback.
+    settings = dict(settings)
+    watchdog = settings.pop('watchdog')
+    timer = StageTimer()
+    try:
+        with watchdog.budget():
+            return (HTid,) + collatevolume(HTid, prefetched=prefetched, writer=writer,
+                                           timer=timer, **settings)
+    except Exception as err:
+        failure = (failurereason(err), timer.failed or 'setup', describe(err))
+    del timer
+
+    ## The first attempt may have got as far as writing some of the output,
+    ## which mustn't be taken for a finished volume.
+    settings['rewrite_existing'] = True
+    if writer is not None:
+        writer.clear()
+    try:
+        with watchdog.budget():
+            status, message, info = collatevolume(HTid, prefetched=prefetched, writer=writer,
+                                                  errors='replace', **settings)
+    except Exception as err:
+        return HTid, 'failed', "{} error: {!r} (quarantined, retry failed)".format(HTid, err), \
+               {'quarantine': failure + ("retry failed: " + describe(err),)}
+    info['quarantine'] = failure + ("retry " + status,)
+    return HTid, status, "{} (quarantined: {} in {}, retried with errors='replace')".format(
+                            message, failure[2], failure[1]), info
+
+
+def _prefetchjob(job):
+    HTid, settings = job
+    if settings is None:
+        return None
+    return prefetchvolume(HTid, **settings)
+
+
+def bigcollate(ids_to_process, collectiondir, rewrite_existing=False,
+                include_divs=True, skip=0, workers=1, chunksize=4, stream=False,
+                manifest=None, check_inputs=False, cache=None, timings=None,
+                compression=None, shards=None, sectiondb=None, headercache=None,
+                serials=None, pipeline=0, timeout=None, memory=None, quarantine=None):
+    '''
+    Collates every volume in ids_to_process. With workers > 1 the volumes are
+    fanned out to a process pool; each worker reads, collates and writes its
+    own volume, and results come back in the order of ids_to_process so the
+    progress log reads exactly as it does in the serial path. stream=True
+    collates each volume in two passes over its zip instead of loading it whole.
+
+    collectiondir is the root of the pairtree, or a filekeeping.PairtreeIndex
+    of it. With an index, each zip (and its size and mtime) is looked up in
+    memory instead of being worked out and probed volume by volume, and so
+    is whether the volume was already collated, as of when the index was
+    built.
+
+    manifest is a Manifest (or the path to one) recording the outcome of every
+    volume. When it is given, volumes it lists as done are skipped without
+    looking for their output files, and everything else (new, failed, missing)
+    is run again. With check_inputs=True the zips of completed volumes are
+    stat'ed as well, and any whose size or mtime has changed are re-run.
+
+    cache is a ResultCache (or the path to a cache directory). Volumes whose
+    zip and collator settings match a cached entry have their output copied
+    from the cache rather than being collated again.
+
+    timings is the path of a file that gets one JSON line per collated volume
+    with the wall time of each stage, page/line/word counts, the number of
+    distinct headers and divs, and peak memory. An end-of-run summary of
+    percentiles and the slowest volumes is printed before 'Done'.
+
+    Output files are written whole to a temporary file and renamed into place,
+    so an interrupted run never leaves partial output. compression ('gzip' or
+    'lzma') compresses the collated text, written as .txt.gz or .txt.xz.
+
+    shards is a ShardStore (or the path to a shard directory). Volumes are
+    then appended to its shard files, with their .meta text in its index,
+    instead of being written into the pairtree. Shards are uncompressed and
+    bypass the result cache, so shards can't be combined with compression or
+    cache.
+
+    sectiondb is a SectionDatabase (or the path to one) that receives the
+    section table of every collated volume as the run goes.
+
+    headercache is a HeaderClusterCache (or the path to one) and serials a
+    dictionary from HTid to serial or record id. Volumes with a serial id
+    have segment() seeded with the running headers found in earlier volumes
+    of the same serial, which keeps section labels consistent across them.
+    The seeds depend on which earlier volumes have finished, so a header
+    cache can't be combined with workers: the output would depend on how
+    the pool happened to schedule the volumes.
+
+    pipeline is a queue depth. When it is set, a reader thread prefetches the
+    zips of up to that many volumes ahead and a writer thread writes finished
+    output behind, so a single process collates while the disk works (see
+    pipeline.Pipeline). Queue depths and stall times are printed before
+    'Done'. The pipeline runs in one process, so it can't be combined with
+    workers.
+
+    timeout (seconds) and memory (megabytes of address space per collating
+    process) put every volume under a watchdog.Watchdog. A volume that goes
+    over budget, or fails in any other way, is interrupted, listed in the
+    quarantine file (if quarantine gives one) with the stage it failed in,
+    and collated once more with errors='replace' decoding. The rest of the
+    run carries on at full speed.
+    '''
+
+    ## Check the compression here rather than failing every volume with it.
+    compressedpath('', compression)
+    if shards is not None and (compression is not None or cache is not None):
+        raise ValueError("shard output can't be combined with compression or a result cache")
+    if pipeline and workers > 1:
+        raise ValueError("pipeline can't be combined with workers")
+    if headercache is not None and workers > 1:
+        raise ValueError("headercache can't be combined with workers")
+
+    if isinstance(shards, str):
+        shards = ShardStore(shards)
+
+    if isinstance(sectiondb, str):
+        sectiondb = SectionDatabase(sectiondb)
+
+    if isinstance(headercache, str):
+        headercache = HeaderClusterCache(headercache)
+    if headercache is not None and serials is None:
+        serials = {}
+
+    if isinstance(manifest, str):
+        manifest = Manifest(manifest)
+
+    if isinstance(cache, str):
+        cache = ResultCache(cache)
+
+    timinglog = TimingLog(timings) if timings is not None else None
+
+    watchdog = None
+    if timeout is not None or memory is not None or quarantine is not None:
+        watchdog = Watchdog(timeout, memory)
+    if isinstance(quarantine, str):
+        quarantine = Quarantine(quarantine)
+
+    done = {}
+    if manifest is not None and not rewrite_existing:
+        done = manifest.completed()
+
+    index = collectiondir if isinstance(collectiondir, PairtreeIndex) else None
+
+    settings = {'collectiondir': None if index is not None else collectiondir,
+                'rewrite_existing': rewrite_existing or manifest is not None,
+                'include_divs': include_divs,
+                'stream': stream,
+                'cache': cache,
+                'timed': timinglog is not None,
+                'compression': compression,
+                'shards': shards,
+                'sections': sectiondb is not None,
+                'headercache': headercache}
+    if watchdog is not None:
+        settings['watchdog'] = watchdog
+
+    ## To skip large sections of the HTid list, provide a count number
+    ids_to_process = iter(ids_to_process)
+    for count, HTid in enumerate(islice(ids_to_process, max(skip - 1, 0)), 1):
+        print("{}: Skipping.".format(count))
+
+    def jobs():
+        for HTid in ids_to_process:
+            if HTid in done and not check_inputs:
+                yield HTid, None
                 continue
-        
-        print(str(count) +": " + HTid)
-
-        # For each HTid, we get a path in the pairtree structure.
-        # Then we read page files, and concatenate them in a list of pages
-        # where each page is a list of lines.
-        
-        pagelist = []
-        
-        try: 
-            with ZipFile(pagepath + filename,mode='r') as zipvol:
-                zippages = zipvol.namelist()
-                zippages.sort()
-                del zippages[0]
-                for f in zippages:
-                    pagecode = zipvol.read(f)
-                    pagetxt = pagecode.decode('utf-8').splitlines(True)
-                    pagelist.append(pagetxt)
-        except FileNotFoundError:
-            print("{}: {} error: file not found".format(count, HTid))
-            continue
-
-        ## Here is where all the collating magic happens. Repeated page headers
-        ## are removed, and used to divde the document into <div>s.
-        
-        pagelist, numberofdivs, metatable, wc = collate(pagelist, 
-                                                    include_divs=include_divs)
-        
-        ## Creates a metadata file from the collator's section divisions.  The metadata is output as
-        ## section #, running header pair in section, section wordcount, first page of section, last page
-        ## of section (as index numbers).  Fields are tab delimited, with the pair of running headers
-        ## delimited with a semi-colon.
-        ##
-        ## For files without running headers, a blank set is written.
-        
-        if include_divs:
-            with open(pagepath + postfix + ".meta",mode='w',encoding='utf-8') as file:
-                file.write(HTid + "\t" + str(numberofdivs) + "\t" + str(wc) +"\n")
-                if metatable == list() or numberofdivs == 1:
-                    file.write("0\tfulltext\t0\t" + str(len(pagelist) - 1) + "\t" + str(wc))
-                else:
-                    for idx,entry in enumerate(metatable):
-                        if idx + 1 < len(metatable):
-                            file.write(str(idx) + "\t" + str(entry[0]) + "\t" + str(entry[1]) + "\t" + str(entry[2][0]) + "\t" + str(entry[2][1]) + "\n")
-                        else:
-                            file.write(str(idx) + "\t" + str(entry[0]) + "\t" + str(entry[1]) + "\t" + str(entry[2][0]) + "\t" + str(entry[2][1]))
-                                   
-        with open(pagepath + postfix + ".txt", mode='w', encoding='utf-8') as file:
-            for page in pagelist:
-                for line in page:
-                    file.write(line)
+            job = settings
+            if HTid in done:
+                job = dict(job, expected=done[HTid])
+            if index is not None:
+                ## Only this volume's entry goes to the worker, not the index.
+                job = dict(job, location=index.get(HTid),
+                           written=index.hasoutput(HTid, compressedpath('.txt', compression)))
+            if headercache is not None and HTid in serials:
+                job = dict(job, serial=serials[HTid])
+            yield HTid, job
+
+    start = max(skip, 1)
+    stages = Pipeline(pipeline) if pipeline else None
+
+    limits = None
+    try:
+        if workers > 1:
+            initializer = watchdog.install if watchdog is not None else None
+            with Pool(workers, initializer) as pool:
+                _report(pool.imap(_collatejob, jobs(), chunksize), start, manifest, timinglog,
+                        sectiondb, quarantine)
+        else:
+            ## The volumes are collated in this process, so the memory
+            ## budget applies to it for the length of the run.
+            if watchdog is not None:
+                limits = watchdog.install()
+            if stages is not None:
+                _report(stages.run(jobs(), _prefetchjob, _collatejob), start, manifest,
+                        timinglog, sectiondb, quarantine)
+            else:
+                _report(map(_collatejob, jobs()), start, manifest, timinglog, sectiondb,
+                        quarantine)
+    finally:
+        if limits is not None:
+            watchdog.uninstall(limits)
+        if manifest is not None:
+            manifest.close()
+        if timinglog is not None:
+            timinglog.close()
+        if shards is not None:
+            shards.close()
+        if sectiondb is not None:
+            sectiondb.close()
+        if headercache is not None:
+            headercache.close()
+        if quarantine is not None:
+            quarantine.close()
+
+    if timinglog is not None:
+        print(timinglog.summary())
+
+    if stages is not None:
+        print(stages.summary())
 
     print('Done')
 
 
-if __name__ == "__main__":
+def _report(results, start, manifest=None, timinglog=None, sectiondb=None, quarantine=None):
+    ## Worker results arrive in submission order, so the count printed here
+    ## lines up with the position of the HTid in ids_to_process.
+    for count, (HTid, status, message, info) in enumerate(results, start):
+        print("{}: {}".format(count, message))
+        if timinglog is not None and 'timing' in info:
+            timinglog.add(info['timing'])
+        if sectiondb is not None and 'sections' in info:
+            sectiondb.record(HTid, *info['sections'])
+        if quarantine is not None and 'quarantine' in info:
+            quarantine.add(HTid, *info['quarantine'])
+        if manifest is not None and status != 'exists':
+            manifest.record(HTid, status, info.get('zipsize'), info.get('zipmtime'),
+                            info.get('checksum'))
 
-    collectiondir = '/Volumes/ELEMENTS/non_google/'
-    
+
+def partition(HTid, count):
+    '''
+    Returns the shard (0 to count - 1) that HTid belongs to when a run is
+    split count ways. The shard comes from a SHA-1 of the id, so every
+    machine assigns every volume to the same shard without talking to the
+    others, whatever order its id file is in.
+    '''
+    digest = sha1(HTid.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % count
+
+
+def readids(path, shard=None, serials=None):
+    '''
+    Reads HTids, one per line, from the file at path. shard is an optional
+    (i, n) pair; only the ids partition() puts in shard i of n are returned.
+    With serials (a dictionary from HTid to serial id), volumes with a
+    serial id are partitioned on it instead, so every volume of a serial
+    falls in the same shard and is collated in order there.
+    '''
+    if serials is None:
+        serials = {}
     HTids_to_process = []
-    with open(collectiondir + 'id',encoding='utf-8') as file:
+    with open(path, encoding='utf-8') as file:
         for line in file:
-            HTids_to_process.append(line.rstrip())
+            HTid = line.rstrip()
+            if HTid and (shard is None
+                         or partition(serials.get(HTid, HTid), shard[1]) == shard[0]):
+                HTids_to_process.append(HTid)
+    return HTids_to_process
+
+
+def readserials(path):
+    '''Reads a tab-delimited file of HTid and serial (or record) id pairs.'''
+    serials = {}
+    with open(path, encoding='utf-8') as file:
+        for line in file:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) >= 2:
+                serials[fields[0]] = fields[1]
+    return serials
+
+
+def shardpath(template, shard):
+    '''Fills {shard} in a per-shard path template, if it has one.'''
+    if template is None:
+        return None
+    return template.replace('{shard}', str(shard))
+
+
+def mergeruns(count, manifest=None, timings=None, sectiondb=None):
+    '''
+    Combines what count shards of a run wrote into one manifest, timing log
+    and section database. Each argument is the path template the shards were
+    run with, containing {shard}; shard i's file is read from the template
+    with i in place of {shard}, and the merged file written with 'all' in its
+    place. Prints the outcome counts of every shard and the merged timing
+    summary, and raises FileNotFoundError if a shard's file is missing (that
+    shard hasn't run, or ran elsewhere).
+    '''
+    templates = [template for template in (manifest, timings, sectiondb) if template is not None]
+    for template in templates:
+        if '{shard}' not in template:
+            raise ValueError("{!r} has no {{shard}} in it".format(template))
+        for shard in range(count):
+            if not os.path.exists(shardpath(template, shard)):
+                raise FileNotFoundError(shardpath(template, shard))
+
+    if manifest is not None:
+        with Manifest(shardpath(manifest, 'all')) as merged:
+            for shard in range(count):
+                path = shardpath(manifest, shard)
+                with Manifest(path) as part:
+                    counts = part.counts()
+                print("{}: {}".format(path, ", ".join("{} {}".format(status, counts[status])
+                                                      for status in sorted(counts))))
+                merged.merge(path)
+            counts = merged.counts()
+            print("merged: {}".format(", ".join("{} {}".format(status, counts[status])
+                                                for status in sorted(counts))))
+
+    if sectiondb is not None:
+        with SectionDatabase(shardpath(sectiondb, 'all')) as merged:
+            for shard in range(count):
+                merged.merge(shardpath(sectiondb, shard))
+
+    if timings is not None:
+        ## The merged log is rebuilt from scratch, as TimingLog appends.
+        open(shardpath(timings, 'all'), mode='w').close()
+        timinglog = TimingLog(shardpath(timings, 'all'))
+        try:
+            for shard in range(count):
+                for record in readlog(shardpath(timings, shard)):
+                    timinglog.add(record)
+        finally:
+            timinglog.close()
+        print(timinglog.summary())
+
 
-    bigcollate(HTids_to_process, collectiondir, rewrite_existing=False, include_divs=True)
\ No newline at end of file
+## Output modes for the command line: the compression of the .txt, or a
+## shard store.
+outputmodes = {'txt': None, 'gzip': 'gzip', 'lzma': 'lzma', 'store': None}
+
+
+def _shardarg(text):
+    try:
+        shard, count = (int(part) for part in text.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected i/n, got {!r}".format(text))
+    if not 0 <= shard < count:
+        raise argparse.ArgumentTypeError("shard must be from 0 to n - 1, got {!r}".format(text))
+    return shard, count
+
+
+def main(argv=None):
+    '''
+    The command line. "run" collates a collection, or one shard of it, and
+    "merge" combines the manifests, timing logs and section databases of a
+    sharded run. Paths given to run may contain {shard}, which is replaced by
+    the shard number, so every shard of a run can share one command line.
+    '''
+    parser = argparse.ArgumentParser(prog='bigcollate',
+        description="Collates HathiTrust zips into .txt and .meta files.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', help="collate a collection, or one shard of it")
+    run.add_argument('collectiondir', help="root of the pairtree")
+    run.add_argument('--ids', help="file of HTids, one per line (default: collectiondir/id)")
+    run.add_argument('--index', help="PairtreeIndex file to look zips up in, instead of "
+                     "probing the pairtree")
+    run.add_argument('--shard', type=_shardarg, metavar='i/n',
+                     help="only collate the HTids that hash to shard i of n (0 <= i < n); "
+                     "with --serials, each serial is hashed as one")
+    run.add_argument('--workers', type=int, default=1)
+    run.add_argument('--chunksize', type=int, default=4)
+    run.add_argument('--pipeline', type=int, default=0, metavar='DEPTH',
+                     help="prefetch and write behind, DEPTH volumes deep")
+    run.add_argument('--stream', action='store_true')
+    run.add_argument('--output', choices=sorted(outputmodes), default='txt',
+                     help="plain .txt, .txt.gz, .txt.xz, or a shard store (see --store)")
+    run.add_argument('--store', help="shard store directory for --output store")
+    run.add_argument('--no-divs', dest='include_divs', action='store_false')
+    run.add_argument('--rewrite', dest='rewrite_existing', action='store_true')
+    run.add_argument('--skip', type=int, default=0)
+    run.add_argument('--manifest')
+    run.add_argument('--check-inputs', action='store_true')
+    run.add_argument('--cache')
+    run.add_argument('--cache-max-bytes', type=int, metavar='BYTES',
+                     help="evict least recently used cache entries past this size")
+    run.add_argument('--timings')
+    run.add_argument('--sectiondb')
+    run.add_argument('--headercache')
+    run.add_argument('--serials', help="tab-delimited file of HTid and serial id pairs")
+    run.add_argument('--timeout', type=float, metavar='SECONDS',
+                     help="time budget per volume")
+    run.add_argument('--memory', type=int, metavar='MB',
+                     help="address space budget per collating process")
+    run.add_argument('--quarantine', help="file listing the volumes that failed under budget")
+
+    merge = commands.add_parser('merge', help="combine the files written by the shards of a run")
+    merge.add_argument('count', type=int, help="number of shards")
+    merge.add_argument('--manifest', help="manifest path template, with {shard}")
+    merge.add_argument('--timings', help="timing log path template, with {shard}")
+    merge.add_argument('--sectiondb', help="section database path template, with {shard}")
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'merge':
+        try:
+            mergeruns(args.count, args.manifest, args.timings, args.sectiondb)
+        except FileNotFoundError as err:
+            parser.error("missing shard file {}".format(err))
+        except ValueError as err:
+            parser.error(str(err))
+        return
+
+    if args.output == 'store' and args.store is None:
+        parser.error("--output store needs --store")
+    shard = args.shard[0] if args.shard is not None else ''
+    collectiondir = args.collectiondir
+    if args.index is not None:
+        collectiondir = PairtreeIndex.load(args.index)
+    cache = shardpath(args.cache, shard)
+    if cache is not None:
+        cache = ResultCache(cache, args.cache_max_bytes)
+    elif args.cache_max_bytes is not None:
+        parser.error("--cache-max-bytes needs --cache")
+    if args.headercache is not None and args.workers > 1:
+        parser.error("--headercache can't be combined with --workers")
+    serials = readserials(args.serials) if args.serials is not None else None
+    HTids_to_process = readids(args.ids or os.path.join(args.collectiondir, 'id'), args.shard,
+                               serials)
+
+    bigcollate(HTids_to_process, collectiondir, rewrite_existing=args.rewrite_existing,
+               include_divs=args.include_divs, skip=args.skip, workers=args.workers,
+               chunksize=args.chunksize, stream=args.stream,
+               manifest=shardpath(args.manifest, shard), check_inputs=args.check_inputs,
+               cache=cache, timings=shardpath(args.timings, shard),
+               compression=outputmodes[args.output],
+               shards=shardpath(args.store, shard) if args.output == 'store' else None,
+               sectiondb=shardpath(args.sectiondb, shard),
+               headercache=shardpath(args.headercache, shard), serials=serials, pipeline=args.pipeline,
+               timeout=args.timeout, memory=args.memory,
+               quarantine=shardpath(args.quarantine, shard))
+
+
+if __name__ == "__main__":
+    main()
@@ -22,17 +22,47 @@
     
 '''
 
+import json
+from array import array
+from collections import Counter
+from contextlib import nullcontext
+from functools import lru_cache
+from itertools import accumulate, chain, islice
 from operator import itemgetter
 
 TabChar="\t"
 
 dice_cutoff = .6
 
+# A volume is treated as having running headers when header candidates recur
+# on more than header_cutoff pages on average. Header pairs seen at least
+# pair_cutoff times mark a section, and sections with fewer than
+# section_cutoff words are folded into their neighbours.
+header_cutoff = 2.5
+pair_cutoff = 4
+section_cutoff = 2000
+
+# The opt-in header-less fast path (see sampleplan) looks at sample_blocks
+# evenly spaced runs of sample_blocklength consecutive pages first. A volume
+# whose sampled header candidates recur goes straight to the full scan.
+sample_blocks = 8
+sample_blocklength = 8
+
 # This is a special alphabet to be used in the bigram index.
 alphabet = ['$', 'a', 'b', 'c', 'd', 'e', 'f', 'g', 'h', 'i', 'j', 'k',
 'l', 'm', 'n', 'o', 'p', 'q', 'r', 's', 't', 'u', 'v', 'w', 'x', 'y',
 'z']
 
+## Position of each alphabet symbol; bigram (first, second) over the alphabet
+## is bit alphabetcodes[first] * len(alphabet) + alphabetcodes[second].
+alphabetcodes = {symbol: idx for idx, symbol in enumerate(alphabet)}
+
+try:
+    popcount = int.bit_count
+except AttributeError:
+    def popcount(bits):
+        return bin(bits).count('1')
+
 def getbigrams(anystring):
     ''' Converts a string to a set of bigrams to be used for matching.'''
 
@@ -53,14 +83,187 @@ def getbigrams(anystring):
 
     return bigramdex
 
+class BigramSet:
+    '''
+    The bigrams of a header, as getbigrams() finds them, encoded over the
+    27-symbol alphabet: every bigram of two alphabet symbols is one bit of an
+    integer, so the bigrams two headers share are counted with an AND and a
+    popcount. Bigrams with any other character in them (digits, punctuation,
+    accented letters) go in a small fallback set of their own, which keeps
+    the count exact.
+    '''
+
+    __slots__ = ('bits', 'others', 'size')
+
+    def __init__(self, bits, others):
+        self.bits = bits
+        self.others = others
+        self.size = popcount(bits) + len(others)
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        ## Bit positions for the alphabet bigrams, then the fallback bigrams.
+        bits = self.bits
+        while bits:
+            low = bits & -bits
+            yield low.bit_length() - 1
+            bits ^= low
+        yield from self.others
+
+    def shared(self, other):
+        '''Returns the number of bigrams this set has in common with other.'''
+        count = popcount(self.bits & other.bits)
+        if self.others and other.others:
+            count += len(self.others & other.others)
+        return count
+
+@lru_cache(maxsize=1 << 16)
+def encodebigrams(anystring):
+    '''
+    Returns the BigramSet of a string. Encodings are memoized, so each
+    distinct header is only encoded once per process.
+    '''
+    anystring = '$' + anystring.replace(' ', '$') + '$'
+    width = len(alphabet)
+    bits = 0
+    others = set()
+    for first, second in zip(anystring, anystring[1:]):
+        if first in alphabetcodes and second in alphabetcodes:
+            bits |= 1 << (alphabetcodes[first] * width + alphabetcodes[second])
+        else:
+            others.add(first + second)
+    return BigramSet(bits, frozenset(others))
+
 def dicecoefficient(firstset, secondset):
     '''Defines a similarity measure between two sets, in this case of bigrams.'''
     if (len(firstset) + len(secondset)) == 0:
         return 0
+    elif isinstance(firstset, BigramSet):
+        return (2 * firstset.shared(secondset)) / (len(firstset) + len(secondset))
     else:
         return (2 * len(firstset.intersection(secondset))) / (len(firstset) + len(secondset))
         
-def segment(headersequence,pagelist,pageheaders):
+class HeaderIndex:
+    '''
+    The header categories segment() has found so far, each with the
+    BigramSet of its normalized header, used to find fuzzy matches for new
+    headers.
+
+    match() returns exactly what an exhaustive dicecoefficient() scan over the
+    valid headers would: the last (highest-coded) header whose coefficient
+    exceeds dice_cutoff. The index is kept the other way round as well: for
+    every bigram, an integer with a bit set for each header code that has
+    it. The bigrams a query shares with every known header are then counted
+    all at once, a few integer operations per query bigram, in a bit-sliced
+    counter (one integer per binary digit of the count). Two bounds pick out
+    the only headers that can clear the cutoff c against a query of size a:
+    their size b must lie within [a*c/(2-c), a*(2-c)/c], and they must share
+    at least c*(a + a*c/(2-c))/2 bigrams with it. Only those are compared
+    exactly, from the highest code down.
+    '''
+
+    __slots__ = ('valid_headers', 'postings', 'bysize', 'pagecounts')
+
+    def __init__(self, headers=()):
+        ## valid_headers stores normalized header names, paired as tuples
+        ## with the bigram set for each so they can be checked as possible
+        ## matches. The position in the list is the header code. postings
+        ## maps each bigram (see BigramSet.__iter__) and bysize each set size
+        ## to a bitmask of header codes. pagecounts holds the number of pages
+        ## segment() assigned to each code.
+        self.valid_headers = []
+        self.postings = {}
+        self.bysize = {}
+        self.pagecounts = array('I')
+        for header in headers:
+            self.add(header, encodebigrams(header))
+
+    def add(self, header, bigramdex):
+        '''Adds a new header category and returns its integer code.'''
+        code = len(self.valid_headers)
+        flag = 1 << code
+        self.valid_headers.append((header, bigramdex))
+        self.bysize[bigramdex.size] = self.bysize.get(bigramdex.size, 0) | flag
+        postings = self.postings
+        for bigram in bigramdex:
+            postings[bigram] = postings.get(bigram, 0) | flag
+        self.pagecounts.append(0)
+        return code
+
+    def match(self, bigramdex):
+        '''
+        Returns (normalized header, code) for the best match to bigramdex
+        (a BigramSet), or None if no known header clears dice_cutoff.
+        '''
+        size = bigramdex.size
+        if size == 0 or not 0 < dice_cutoff < 2:
+            return self._scan(bigramdex)
+
+        ## Small slack on the float bounds so they can only ever admit
+        ## extra candidates; the exact test below makes the final call.
+        shortest = size * dice_cutoff / (2 - dice_cutoff) - 1e-9
+        longest = size * (2 - dice_cutoff) / dice_cutoff + 1e-9
+        overlap = max(int(dice_cutoff * (size + shortest) / 2), 1)
+
+        window = 0
+        for matchsize, codes in self.bysize.items():
+            if shortest <= matchsize <= longest:
+                window |= codes
+        if not window:
+            return None
+
+        ## planes[i] holds binary digit i of the number of bigrams each
+        ## header shares with the query.
+        planes = []
+        postings = self.postings
+        for bigram in bigramdex:
+            carry = postings.get(bigram, 0) & window
+            for digit, plane in enumerate(planes):
+                if not carry:
+                    break
+                planes[digit] = plane ^ carry
+                carry &= plane
+            if carry:
+                planes.append(carry)
+
+        ## Headers sharing at least overlap bigrams, compared digit by digit
+        ## from the top.
+        if overlap >> len(planes):
+            return None
+        candidates = 0
+        equal = window
+        for digit in range(len(planes) - 1, -1, -1):
+            if (overlap >> digit) & 1:
+                equal &= planes[digit]
+            else:
+                candidates |= equal & planes[digit]
+                equal &= ~planes[digit]
+        candidates |= equal
+
+        ## The exhaustive scan keeps the last match it sees, so walk the
+        ## candidates from the highest code down and stop at the first hit.
+        while candidates:
+            code = candidates.bit_length() - 1
+            possible_match, match_bigramdex = self.valid_headers[code]
+            matchsize = match_bigramdex.size
+            if (2 * bigramdex.shared(match_bigramdex)) / (size + matchsize) > dice_cutoff:
+                return possible_match, code
+            candidates ^= 1 << code
+
+        return None
+
+    def _scan(self, bigramdex):
+        ## Degenerate cutoffs give no useful bound, so fall back to
+        ## comparing against every valid header.
+        best = None
+        for code, (possible_match, match_bigramdex) in enumerate(self.valid_headers):
+            if dicecoefficient(bigramdex, match_bigramdex) > dice_cutoff:
+                best = possible_match, code
+        return best
+
+def segment(headersequence,pagelist,pageheaders,wordcounts=None,index=None):
     '''
     This function accepts a list of header known header strings, ordered by frequency,
     the full text of the document in question, and a list of page header strings in
@@ -69,6 +272,10 @@ def segment(headersequence,pagelist,pageheaders):
     pairs of headers (any pair that appears more than 4 times is a section).  Also
     removes errors in division by merging any continguous group of pages that share the
     same section number but have less than 2,000 words into the next section.
+    Word counts are taken from wordcounts (one entry per page) when given, so
+    pagelist can be None. index is an optional HeaderIndex already holding
+    header categories (from earlier volumes of a serial, say); headers that
+    match one of them are normalized to it. The index is updated in place.
     '''
     
     # headerdict holds a dictionary of translation rules mapping actually-occurring
@@ -80,39 +287,34 @@ def segment(headersequence,pagelist,pageheaders):
     # translation rule to the headerdict. Otherwise, add it to the headerdict
     # as itself.
     #
-    # valid_headers stores normalized header names, paired as tuples
-    # with the bigram index for each so they can be checked as possible
-    # matches.
+    # The HeaderIndex holds the valid (normalized) headers along with their
+    # bigrams encoded as bitsets, and finds the known headers that share
+    # enough bigrams with each new one in a few integer operations.
     
     headerdict = {}
-    valid_headers = []
+    if index is None:
+        index = HeaderIndex()
     
-    for idx,header in enumerate(headersequence):
-        bigramdex = getbigrams(header[0])
-        matched = False
-
-        for idx, entrytuple in enumerate(valid_headers):
-            possible_match, match_bigramdex  = entrytuple
-            dice = dicecoefficient(bigramdex, match_bigramdex)
-            
-            if dice > dice_cutoff:
-                headerdict[header[0]] = (possible_match, idx)
-                matched = True
+    for header in headersequence:
+        bigramdex = encodebigrams(header[0])
+        match = index.match(bigramdex)
 
-        if matched == False:
-            entrytuple = header[0], bigramdex
-            headerdict[header[0]] = (header[0], len(valid_headers))
-            valid_headers.append(entrytuple)
-            # We use the current length of valid_headers to
-            # establish an integer code for this header category.
+        if match is None:
+            headerdict[header[0]] = (header[0], index.add(header[0], bigramdex))
+            # The index hands out the current number of valid headers
+            # as the integer code for this header category.
+        else:
+            headerdict[header[0]] = match
 
     # Now go back through the original list of pageheaders and use
     # headerdict to translate it into a list of header codes.
     
     headercodes = []
+    pagecounts = index.pagecounts
     for header in pageheaders:
         normalized, header_code = headerdict[header]
         headercodes.append(header_code)
+        pagecounts[header_code] += 1
 
     ## Once the list of header codes has been established, run through the list
     ## and count the number of pairings (both before and after)
@@ -147,7 +349,7 @@ def segment(headersequence,pagelist,pageheaders):
     validpairs = {}
     
     for pair in paircounts:
-        if paircounts[pair] >= 4:
+        if paircounts[pair] >= pair_cutoff:
             validpairs[pair] = paircounts[pair]
             
     ## Go back through the list and assign section codes to pairs of headers. The dicionary
@@ -218,116 +420,31 @@ def segment(headersequence,pagelist,pageheaders):
             
         sectioncodes.append(add)
 
-    ## This loop examines the just created section code list to make corrections
-    ## where invalid sections appear.  Start with 0 because first section should
-    ## be zero.  First, check if beginning of index or end of index (since those
-    ## are easy to fix).  Otherwise, count forward to for the next non-error code.
-    ## Then compare distance between last known non-error and the next non-error.
-    ## When correcting, update the last known section ID and last known index so
-    ## that there's no need to loop bakwards to make corrections.
-    
-    lastsection = 0
-    lastknowndex = 0
-    
-    for idx,page in enumerate(sectioncodes):
-        if page != 999:
-            lastsection = page
-            lastknowndex = idx
-        elif idx == 0:
-            for replace in sectioncodes:
-                if replace != 999:
-                    sectioncodes[idx] = replace
-                    lastknowndex = idx
-                    break
-        elif idx == len(sectioncodes) - 1:
-            sectioncodes[idx] = sectioncodes[idx - 1]
-        else:
-            count = 0
-            for replace in sectioncodes[idx:]:
-                count += 1
-                if replace != 999:
-                    break
-            if (idx - lastknowndex) > count:
-                sectioncodes[idx] = sectioncodes[idx + count]
-                lastsection = page
-                lastknowndex = idx
-            elif (idx - lastknowndex) < count:
-                sectioncodes[idx] = lastsection
-                lastknowndex = idx
-            elif paircounts[sectionlist[sectioncodes[idx - lastknowndex]]] > paircounts[sectionlist[sectioncounts[idx + count]]]:
-                sectioncodes[idx] = lastsection
-                lastknowndex = idx
-            else:
-                sectioncodes[idx] = sectioncodes[idx + count]
-                lastsection = page
-                lastknowndex = idx
+    ## Pages whose header pairing is invalid (999) take the code of a
+    ## neighbouring page; see fillgaps().
 
-    ## These loops count the words in each section to establish which are too short
-    ## and then folds those with less than 2,000 words into the closest neighboring
-    ## section (that has more than 2,000 words)
-    
-    wordcount = list()
-    checking = 0
-    start = 0
-    sectcount = 0
-    
-    ## Figure out continguous sections and count the worlds in them.
-    
-    for idx,page in enumerate(pagelist):
-        if checking != sectioncodes[idx]:
-            wordcount.append((start,idx-1,sectcount))
-            start = idx
-            checking = sectioncodes[idx]
-            sectcount = 0
-        for line in page:
-            words = line.split()
-            sectcount += len(words)
-        if idx == len(pagelist) - 1:
-            wordcount.append((start,idx,sectcount))
-
-    ## Put section ranges of those with less than 2,000 into a set
-    ## as tuples for if in checks during correction.
-    
-    removes = set()
-    
-    for idx,section in enumerate(wordcount):
-        if section[2] < 2000:
-            removes.add((section[0],section[1]))
-
-    ## Look at the word counts for each contiguous section.  If
-    ## it has been highlighted for removal, then give it the next
-    ## section's code.  If the last section needs to be removed,
-    ## give it the same code as the previous one.
+    fillgaps(sectioncodes)
+
+    ## Count the words in each contiguous run of pages sharing a section code,
+    ## then fold runs with fewer than section_cutoff words into the closest
+    ## neighbouring run that has enough.
     
-    lastvalidcode = 0
-    for idx,section in enumerate(wordcount):
-        if (section[0],section[1]) in removes:
-            pagecodes = range(section[0],section[1]+1)
-            newcode = -1
-            if idx < len(wordcount) - 1:
-                for x in wordcount[idx:]:
-                    if (x[0],x[1]) not in removes:
-                        newcode = sectioncodes[x[0]]
-                        lastvalidcode = newcode
-                        break
-            if newcode == -1:
-                newcode = lastvalidcode
-
-            for x in pagecodes:
-                sectioncodes[x] = newcode
-            
-        else:
-            lastvalidcode = sectioncodes[section[0]]
+    if wordcounts is None:
+        wordcounts = [pagewordcount(page) for page in pagelist]
+
+    sectionruns = SectionRuns.fromcodes(sectioncodes, wordcounts)
+    sectionruns.foldshort(section_cutoff)
 
     ## This could probably be compressed but I don't want to fix what
     ## is working.  Create a set of headerdict's values, then extracts
     ## just the normalized names.
 
-    temp = set(headerdict.values())
-    headerkey = [''] * len(temp)
-    for header in temp:
+    ## With a seeded index the codes in use need not run from 0 without gaps,
+    ## so headerkey is a dictionary rather than a list.
+
+    headerkey = {}
+    for header in set(headerdict.values()):
         headerkey[header[1]] = header[0]
-    del temp
         
     metadata = [''] * len(sectionlist)
 
@@ -338,13 +455,43 @@ def segment(headersequence,pagelist,pageheaders):
     for i, section in enumerate(sectionlist):
         metadata[i] = headerkey[section[0]] + ';' + headerkey[section[1]]
             
-    ## Return sectioncodes so div's can be generated using metadata.  Return
+    ## Return the section runs so div's can be generated using metadata.  Return
     ## headerdict so pre-normalized section headers can be identified and removed
     ## during collation.
             
-    return sectioncodes, headerdict, metadata
+    return sectionruns, headerdict, metadata
+
+def fillgaps(sectioncodes):
+    '''
+    Replaces the error code 999 in sectioncodes, in place, with a valid section
+    code from a neighbouring page. The first page takes the first valid code
+    in the volume, the last page takes the code of the page before it, and
+    every other page takes the last valid code seen before it (0 if none).
 
-def correctsequence(sectioncodes,metadata,pagelist):
+    This is a single pass. The loop it replaces counted forward to the next
+    valid code for every 999 and compared the distance to it with the
+    distance back to the last corrected page. That page was always the one
+    just before, so the backward side always won, and the tie-break (which
+    referred to an undefined sectioncounts) could never be reached. The
+    assignments are the same.
+    '''
+    last = len(sectioncodes) - 1
+    lastsection = 0
+    for idx, page in enumerate(sectioncodes):
+        if page != 999:
+            lastsection = page
+        elif idx == 0:
+            for replace in sectioncodes:
+                if replace != 999:
+                    sectioncodes[idx] = replace
+                    break
+        elif idx == last:
+            sectioncodes[idx] = sectioncodes[idx - 1]
+        else:
+            sectioncodes[idx] = lastsection
+    return sectioncodes
+
+def correctsequence(sectioncodes,metadata,pagelist,wordcounts=None):
     '''
     After sections have been determined, the codes need to be adjusted
     so that they appear in the correct sequence.  IE, [2,3,1,0,4,7,8]
@@ -354,158 +501,461 @@ def correctsequence(sectioncodes,metadata,pagelist):
     from the segmentation function for debug/developmental purposes, but the
     two are meant to be run together on texts to completely prepare them for
     the final collation loop.
+
+    sectioncodes is the SectionRuns segment() returns; a list of per-page
+    codes is also accepted, in which case the words are counted from
+    wordcounts (or, failing that, pagelist). Returns the renumbered
+    SectionRuns and the metadata table.
     '''
+
+    if isinstance(sectioncodes, SectionRuns):
+        sectionruns = sectioncodes
+    else:
+        if wordcounts is None:
+            wordcounts = [pagewordcount(page) for page in pagelist]
+        sectionruns = SectionRuns.fromcodes(sectioncodes, wordcounts)
+
+    ## Runs that folding left with the same code as their neighbour are one
+    ## section. Each section is then renumbered in order from 0, and the
+    ## metadata table gets its name, word count and a tuple noting its bounds
+    ## for use in placing div's without needing a loop to "re-discover" them
+    ## later. The bounds are as the page-by-page version of this loop
+    ## recorded them: a section ends on the first page of the next one, and
+    ## each section after the first starts one page after that.
     
-    fixtable = []
+    sectionruns = sectionruns.coalesce()
     fixedmeta = []
-    last = sectioncodes[0]
-    change = 0
     start = 0
+    last = len(sectionruns) - 1
 
-    ## Look through the list of section codes for each page and change
-    ## them to a normal iteration beginning with 0.  If the current page
-    ## has a new code, then increase the corrected section code and
-    ## make a note of where the break so that the metadata table can be
-    ## updated to reflect the new section breaks.
-    
-    for idx, page in enumerate(sectioncodes):
-        if page != last:
-            change += 1
-            fixtable.append((last,start,idx))
-            start = idx + 1
-            last = page
-        if idx == len(sectioncodes) - 1:
-            fixtable.append((last,start,idx))
-        sectioncodes[idx] = change
-
-    ## When preparing the full metadata table, include the section
-    ## name as well as a word count (initialized at zero) and a
-    ## tuple that notes the bounds of that section for use in placing
-    ## div's without needing a loop to "re-discover" them later.
-    for code in fixtable:
-        fixedmeta.append([metadata[code[0]],0,(code[1],code[2])])
-    
-    for idx,page in enumerate(pagelist):
-        for line in page:
-            words = line.split()
-            fixedmeta[sectioncodes[idx]][1] += len(words)
-            
-    ## The metadata is supposed to be a tuple, so better correct that
-    ## before it gets returned!
-            
-    for idx,code in enumerate(fixedmeta):
-        fixedmeta[idx] = tuple(code)
+    for idx, (first, end, code, words) in enumerate(sectionruns):
+        if idx < last:
+            end = sectionruns.starts[idx + 1]
+        fixedmeta.append((metadata[code], words, (start, end)))
+        start = end + 1
+        sectionruns.codes[idx] = idx
     
-    return sectioncodes, fixedmeta
+    return sectionruns, fixedmeta
+
+class SectionRuns:
+    '''
+    A volume's section assignments, run-length encoded: one entry per run of
+    consecutive pages sharing a section code, holding the run's first and last
+    page, its code and its word count in parallel arrays. segment() and
+    correctsequence() work on runs, so merging and renumbering sections costs
+    time in proportion to the number of sections rather than pages.
+    '''
+
+    __slots__ = ('starts', 'ends', 'codes', 'words')
+
+    def __init__(self):
+        self.starts = array('l')
+        self.ends = array('l')
+        self.codes = array('l')
+        self.words = array('q')
+
+    @classmethod
+    def fromcodes(cls, sectioncodes, wordcounts):
+        '''Builds the runs from per-page section codes and word counts.'''
+        runs = cls()
+        start = 0
+        words = 0
+        for idx, code in enumerate(sectioncodes):
+            if idx > 0 and code != sectioncodes[idx - 1]:
+                runs.append(start, idx - 1, sectioncodes[idx - 1], words)
+                start = idx
+                words = 0
+            words += wordcounts[idx]
+        if len(sectioncodes) > 0:
+            runs.append(start, len(sectioncodes) - 1, sectioncodes[-1], words)
+        return runs
+
+    def append(self, start, end, code, words):
+        self.starts.append(start)
+        self.ends.append(end)
+        self.codes.append(code)
+        self.words.append(words)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __iter__(self):
+        return zip(self.starts, self.ends, self.codes, self.words)
+
+    def pagecodes(self):
+        '''Returns the section code of every page, as a list.'''
+        pagecodes = []
+        for start, end, code, words in self:
+            pagecodes.extend([code] * (end - start + 1))
+        return pagecodes
+
+    def foldshort(self, cutoff):
+        '''
+        Gives every run with fewer than cutoff words the code of the next run
+        that has enough, or, when none follows, the code of the last one
+        before it (0 if there is none). Runs are not merged here; see
+        coalesce().
+        '''
+        codes = self.codes
+        words = self.words
+
+        ## nextvalid[idx] is the first run after idx with enough words, or -1.
+        nextvalid = array('l', [-1]) * len(codes)
+        following = -1
+        for idx in range(len(codes) - 1, -1, -1):
+            nextvalid[idx] = following
+            if words[idx] >= cutoff:
+                following = idx
+
+        lastvalidcode = 0
+        for idx in range(len(codes)):
+            if words[idx] < cutoff:
+                if nextvalid[idx] >= 0:
+                    lastvalidcode = codes[nextvalid[idx]]
+                codes[idx] = lastvalidcode
+            else:
+                lastvalidcode = codes[idx]
+
+    def coalesce(self):
+        '''Returns new runs in which neighbouring runs with the same code are joined.'''
+        runs = SectionRuns()
+        for start, end, code, words in self:
+            if len(runs) > 0 and runs.codes[-1] == code:
+                runs.ends[-1] = end
+                runs.words[-1] += words
+            else:
+                runs.append(start, end, code, words)
+        return runs
+
+## Characters dropped before checking whether a top line is mostly numbers,
+## and characters stripped before checking it against the known headers.
+numberpunctuation = str.maketrans('', '', '. []_-"\',')
+headerstrip = '0123456789.,!@#$%^&*()[]<> -_"\'\n'
 
 def removeheader(remove, page, num=False):
     '''
-    This is a recursive algorithm that checks for page numbers or
-    running headers for removal.  Each time a line is identified for
-    removal, call the function again to make sure the next line doesn't
-    also need removal.  Accepts a page and the list of known headers.
-    Num is a hidden value used only by the recursive loop to avoid
-    recursion errors that could result with a page that is nothing
-    but numbers.
+    Checks the top of a page for page numbers or running headers and removes
+    them.  Each time a line is identified for removal, the next line is checked
+    too, so blank lines, page numbers and headers can be peeled off in any
+    order.  Accepts a page and the list of known headers.  Num records that a
+    bare page number has already been removed; after that only blank lines and
+    headers are taken off, which keeps a page that is nothing but numbers
+    from being emptied.
+
+    The page is scanned once to find the first line that survives, and
+    everything above it is deleted in a single slice, so the page is changed in
+    place and returned.
+    '''
+    first = headerlines(remove, page, num)
+    if first > 0:
+        del page[:first]
+    return page
+
+def headerlines(remove, lines, num=False):
+    '''
+    Returns how many lines at the top of lines removeheader() would take off.
+    lines can be any iterable of lines; it is read only as far as the first
+    line that stays.
     '''
-    if len(page) == 0:
-        return page
-        
-    header = page[0]
-    header = header.strip(' \n')
+    first = 0
+    for line in lines:
+        header = line.strip(' \n')
 
-    ## If the first line is empty, remove it.    
-    if len(header) == 0:
-        del page[0]
-        return removeheader(remove,page,num)
-    
-    ## This pair of conditionals will remove any lines that are presumably
-    ## page numbers (else checks for errors by eliminating lines with more
-    ## than 40% numerics).
-    elif header.isnumeric() and not num:
-        del page[0]
-        return removeheader(remove,page,True)  
-    elif not num:
-        header = header.replace('.','')
-        header = header.replace(' ','')
-        header = header.replace('[','')
-        header = header.replace(']','')
-        header = header.replace('_','')
-        header = header.replace('-','')
-        header = header.replace('"','')
-        header = header.replace("'","")
-        header = header.replace(',','')
-        
+        ## If the line is empty, remove it.
         if len(header) == 0:
-            del page[0]
-            return removeheader(remove,page,num)
-
-        numcount = 0
-        for char in header:
-            if char.isnumeric():
-                numcount += 1
-        if numcount / len(header) >= 0.4:
-            del page[0]
-            return removeheader(remove,page,num)
-    
-    ## If it escapes the above sequence without recursion, then most characters
-    ## are alphabetical.  Check to see if it's a header.  If it's a header,
-    ## then call this function one last time (hopefully).  If it's an
-    ## alphabetic line that isn't a header, then there's no need to call again.
-    header = page[0].strip('0123456789.,!@#$%^&*()[]<> -_"\'\n')
-    header = header.lower()
-    if header in remove and len(header) > 0 and header != 'pb':
-        del page[0]
-        return removeheader(remove,page,num)
-    else:
-        return page
+            first += 1
+            continue
 
-def collate(pagelist, include_divs=True):
+        ## This pair of conditionals will remove any lines that are presumably
+        ## page numbers (else checks for errors by eliminating lines with more
+        ## than 40% numerics).
+        if not num:
+            if header.isnumeric():
+                num = True
+                first += 1
+                continue
+
+            header = header.translate(numberpunctuation)
+            if len(header) == 0:
+                first += 1
+                continue
+            if sum(map(str.isnumeric, header)) / len(header) >= 0.4:
+                first += 1
+                continue
+
+        ## If it escapes the above sequence, then most characters are
+        ## alphabetical.  Check to see if it's a header.  If it's a header,
+        ## remove it and look at the next line.  If it's an alphabetic line
+        ## that isn't a header, then the top of the page has been found.
+        header = line.strip(headerstrip).lower()
+        if header in remove and len(header) > 0 and header != 'pb':
+            first += 1
+            continue
+        break
+
+    return first
+
+class Page:
     '''
-    Accepts a list of pages (each of which is a list of lines) and reads through them,
-    discovering headers (if present) and guessing section divisions based on pairing
-    patterns.  Returns the prepared text, ready for writing to disk (or analysis by
-    functions from other libraries).
+    A compact page: the page's text as one string, with the offset at which
+    each line starts in an array, instead of a list of line strings. A
+    thousand-page serial then costs little more than its text in memory.
 
-    rlmv: MODIFIED: hacked in no_divs to produce collated pages with no tags.
+    A Page reads like the list of lines it replaces (len(), indexing,
+    slicing, iteration), and supports the edits collatepage() makes to a
+    page: deleting lines from the top only moves the offset of the first
+    line, and lines added to either end (tags, the cleaned-up last line) are
+    kept in short lists beside the text. collate() accepts and returns Pages
+    as well as lists of lines, and the output is the same.
     '''
-    pageheaders = []
-    for page in pagelist:
-        header = ""
-        for line in page:
-            # Current strategy: the running header is the first line
-            # with more than four characters in it.
-            
-            ## NEW CODE
-            templine = line.replace('.','')
-            templine = templine.replace(' ','')
-            templine = templine.replace('[','')
-            templine = templine.replace(']','')
-            templine = templine.replace('_','')
-            templine = templine.replace('-','')
-            numcount = 0
-            for char in templine:
-                if char.isnumeric():
-                    numcount += 1
-            if len(templine) == 0:
-                numscore = 0
-            else:
-                numscore = numcount / len(templine)
-            ## END NEW CODE
-            
-            if len(line) < 5 or line.isdigit() or numscore >= 0.4:  ## NEW ITEM IN CONDITIONAL
-                continue
+
+    __slots__ = ('text', 'offsets', 'first', 'before', 'after')
+
+    def __init__(self, text, offsets):
+        self.text = text
+        ## offsets[k] is where line k starts; the last entry is where the
+        ## last line ends.
+        self.offsets = offsets
+        self.first = 0
+        self.before = ()
+        self.after = ()
+
+    @classmethod
+    def fromtext(cls, text):
+        '''Makes a Page of text, split into lines as str.splitlines(True) does.'''
+        return cls(text, array('I', accumulate(map(len, text.splitlines(True)), initial=0)))
+
+    @classmethod
+    def fromlines(cls, lines):
+        '''Makes a Page of a list of lines.'''
+        return cls(''.join(lines), array('I', accumulate(map(len, lines), initial=0)))
+
+    def _lines(self):
+        return len(self.offsets) - 1 - self.first
+
+    def __len__(self):
+        return len(self.before) + self._lines() + len(self.after)
+
+    def _line(self, idx):
+        ## idx is a non-negative index into the lines of the page.
+        if idx < len(self.before):
+            return self.before[idx]
+        idx -= len(self.before)
+        if idx < self._lines():
+            idx += self.first
+            return self.text[self.offsets[idx]:self.offsets[idx + 1]]
+        return self.after[idx - self._lines()]
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self._line(k) for k in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("page index out of range")
+        return self._line(idx)
+
+    def __iter__(self):
+        yield from self.before
+        offsets = self.offsets
+        text = self.text
+        for idx in range(self.first, len(offsets) - 1):
+            yield text[offsets[idx]:offsets[idx + 1]]
+        yield from self.after
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __str__(self):
+        return (''.join(self.before) + self.text[self.offsets[self.first]:self.offsets[-1]]
+                + ''.join(self.after))
+
+    def __repr__(self):
+        return 'Page({!r})'.format(list(self))
+
+    def append(self, line):
+        if not self.after:
+            self.after = []
+        self.after.append(line)
+
+    def extend(self, lines):
+        if not self.after:
+            self.after = []
+        self.after.extend(lines)
+
+    def insert(self, idx, line):
+        '''Inserts a line; only at the top of the page.'''
+        if idx != 0:
+            raise IndexError("lines can only be inserted at the top of a Page")
+        self.before = [line] + list(self.before)
+
+    def __setitem__(self, idx, line):
+        '''Replaces a line; only the last line of the page.'''
+        if idx != -1 and idx != len(self) - 1:
+            raise IndexError("only the last line of a Page can be replaced")
+        del self[-1]
+        self.append(line)
+
+    def __delitem__(self, idx):
+        '''Deletes lines from the top of the page, or its last line.'''
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(len(self))
+            if start != 0 or step != 1:
+                raise IndexError("only lines at the top of a Page can be deleted")
+            count = max(stop, 0)
+            if self.before:
+                dropped = min(count, len(self.before))
+                self.before = self.before[dropped:]
+                count -= dropped
+            dropped = min(count, self._lines())
+            self.first += dropped
+            count -= dropped
+            if count:
+                self.after = self.after[count:]
+        elif idx == -1 or idx == len(self) - 1:
+            if self.after:
+                self.after.pop()
+            elif self._lines() > 0:
+                self.offsets.pop()
+            elif self.before:
+                self.before = self.before[:-1]
             else:
-                header = line.strip('1234567890. ,[]"\t\n')  ## ADDED STRIPS TO PUNCTUATION!
-                header = header.lower()
-                # Here it would also be nice to have a function
-                # that strips roman numerals, when they constitute
-                # a separate word, without automatically stripping
-                # all i's and v's from the header.
-                
-                break
-            
-        pageheaders.append(header)
+                raise IndexError("page index out of range")
+        else:
+            raise IndexError("only lines at the top of a Page, or its last line, can be deleted")
+
+def pagetext(page):
+    '''Returns the text of a page, a Page or a list of lines, as one string.'''
+    if isinstance(page, Page):
+        return str(page)
+    return ''.join(page)
+
+class PageTable:
+    '''
+    The per-page features of a volume, gathered once and shared by every later
+    stage: the running header candidate, the share of numerals in the line it
+    came from (its numeric score), and the page's word count. Scores and word
+    counts are kept in arrays so a table for a thousand-page serial stays small.
+
+    header_lines limits how many lines from the top of each page are considered
+    as header candidates; None looks as far down the page as it takes.
+    '''
+
+    __slots__ = ('headers', 'scores', 'wordcounts', 'header_lines')
+
+    def __init__(self, pages=(), header_lines=None):
+        self.headers = []
+        self.scores = array('d')
+        self.wordcounts = array('I')
+        self.header_lines = header_lines
+        self.extend(pages)
+
+    def __len__(self):
+        return len(self.headers)
+
+    def add(self, page):
+        '''Scans a page (a list of lines) and appends its features.'''
+        self.extend((page,))
+
+    def append(self, header, score, words):
+        '''Appends features worked out elsewhere (see pagesource.py).'''
+        self.headers.append(header)
+        self.scores.append(score)
+        self.wordcounts.append(words)
+
+    def extend(self, pages):
+        '''Appends the features of each page in an iterable of pages.'''
+        headers = self.headers
+        scores = self.scores
+        wordcounts = self.wordcounts
+        header_lines = self.header_lines
+        for page in pages:
+            header, score = pageheader(page, header_lines)
+            headers.append(header)
+            scores.append(score)
+            wordcounts.append(pagewordcount(page))
+
+## Characters ignored when working out how much of a candidate line is numbers,
+## and characters stripped from the line once it is taken as the header.
+candidatepunctuation = str.maketrans('', '', '. []_-')
+candidatestrip = '1234567890. ,[]"\t\n'
+
+def headerline(page, header_lines=None):
+    '''
+    Returns (index, numeric score) of the line that pageheader() takes as the
+    running header, or (-1, 0.0) if no line (within the first header_lines
+    lines, if given) qualifies.
+    '''
+    if header_lines is not None:
+        page = page[:header_lines]
+
+    for idx, line in enumerate(page):
+        # Current strategy: the running header is the first line
+        # with more than four characters in it.  The cheap length
+        # and digit tests run first, so short lines never get as
+        # far as counting numerals.
+
+        if len(line) < 5 or line.isdigit():
+            continue
+
+        templine = line.translate(candidatepunctuation)
+        if len(templine) == 0:
+            numscore = 0.0
+        else:
+            numscore = sum(map(str.isnumeric, templine)) / len(templine)
+        if numscore >= 0.4:
+            continue
+
+        return idx, numscore
+
+    return -1, 0.0
+
+def pageheader(page, header_lines=None):
+    '''
+    Returns (header, numeric score) for a page. The header is the first line
+    that is long enough and not mostly numbers, stripped of page numbers and
+    punctuation and lower-cased; pages without one (within the first
+    header_lines lines, if given) get an empty string and a score of 0.
+    '''
+    idx, numscore = headerline(page, header_lines)
+    return headertext(page, idx), numscore
+
+def headertext(page, idx):
+    '''Returns the header string for the line headerline() picked.'''
+    if idx < 0:
+        return ""
+
+    header = page[idx].strip(candidatestrip)  ## ADDED STRIPS TO PUNCTUATION!
+    # Here it would also be nice to have a function
+    # that strips roman numerals, when they constitute
+    # a separate word, without automatically stripping
+    # all i's and v's from the header.
+    return header.lower()
+
+def extractheaders(pages, header_lines=None):
+    '''Returns the list of running header candidates, one per page.'''
+    return [pageheader(page, header_lines)[0] for page in pages]
+
+def pagewordcount(page):
+    '''Counts the whitespace-delimited words on a page.'''
+    if isinstance(page, Page):
+        ## Every line break is whitespace to str.split(), so the page can be
+        ## split whole.
+        return len(str(page).split())
+    return sum(map(len, map(str.split, page)))
+
+def plancollation(pagetable, timer=None, headerindex=None):
+    '''
+    Works out everything the collation loop needs from a volume's PageTable
+    alone: where each <div> opens and closes, which header forms to strip from
+    the tops of pages, the section metadata table and the total word count.
+    Returns (divplace, remove, metadata, wc).
+
+    Because the pages themselves are not needed here, a caller can build the
+    table in one pass over a volume and collate the pages in a second pass
+    (see streamcollate()). timer is an optional timing.StageTimer, and
+    headerindex an optional HeaderIndex to seed segment() with.
+    '''
 
     # Now we construct a dictionary where headers are associated with
     # the number of times they occur in pageheaders. Misspellings,
@@ -514,6 +964,9 @@ def collate(pagelist, include_divs=True):
     # an order-in-which-to-consider the possibilities, which is going to
     # be based on frequency of occurrence.
     
+    pageheaders = pagetable.headers
+    wordcounts = pagetable.wordcounts
+
     headerdict = {}
     for header in pageheaders:
         if header in headerdict:
@@ -533,9 +986,11 @@ def collate(pagelist, include_divs=True):
     ## headers, but a dummy divplace and a dummy remove will still need to be created
     ## for the collation loop.
 
-    if avg_freq > 2.5:
-        sectioncodes, headerdict, metadata = segment(headersequence,pagelist,pageheaders)
-        sectioncodes,metadata = correctsequence(sectioncodes, metadata,pagelist)
+    if avg_freq > header_cutoff:
+        with stage(timer, 'segment'):
+            sectioncodes, headerdict, metadata = segment(headersequence,None,pageheaders,wordcounts,headerindex)
+        with stage(timer, 'correctsequence'):
+            sectioncodes,metadata = correctsequence(sectioncodes, metadata,None,wordcounts)
 
     else:
         sectioncodes = [0] * len(pageheaders)
@@ -552,13 +1007,9 @@ def collate(pagelist, include_divs=True):
     
     divplace = {}
     
-    wc = 0
-    for page in pagelist:
-        for line in page:
-            words = line.split()
-            wc += len(words)
+    wc = sum(wordcounts)
     
-    if avg_freq > 2.5:
+    if avg_freq > header_cutoff:
         for idx,section in enumerate(metadata):
             divplace[section[2][0]] = (section[2][1],section[0],section[1],idx)
     else:
@@ -574,7 +1025,7 @@ def collate(pagelist, include_divs=True):
     
     remove = set()
     
-    if avg_freq > 2.5:
+    if avg_freq > header_cutoff:
         for key, value in headerdict.items():
             remove.add(key)
             remove.add(value)
@@ -588,6 +1039,159 @@ def collate(pagelist, include_divs=True):
             else:
                 break
 
+    return divplace, remove, metadata, wc
+
+def sampleindices(pagecount, blocks=None, blocklength=None):
+    '''
+    Returns the indices of the pages sampleplan() looks at: blocks evenly
+    spaced runs of blocklength consecutive pages, so running headers, which
+    alternate from page to page, recur within each run. A single block
+    starts at the first page. blocks and blocklength default to the module
+    settings sample_blocks and sample_blocklength. Returns None for volumes
+    too short for sampling to save anything.
+    '''
+    if blocks is None:
+        blocks = sample_blocks
+    if blocklength is None:
+        blocklength = sample_blocklength
+    if blocks < 1 or blocklength < 1:
+        raise ValueError("sampling needs at least one block of at least one page")
+    if pagecount <= 2 * blocks * blocklength:
+        return None
+    span = pagecount - blocklength
+    indices = []
+    for block in range(blocks):
+        start = block * span // max(blocks - 1, 1)
+        indices.extend(range(start, start + blocklength))
+    return indices
+
+def sampleplan(pagelist, header_lines=None, timer=None):
+    '''
+    The header-less fast path of collate(). Looks for header candidates on a
+    sample of pages first (see sampleindices), and leaves the volume to the
+    full scan straight away if any recur there. Otherwise it builds the
+    volume's PageTable and, if no candidate recurs anywhere and the volume
+    fails the running header test, works out the (divplace, remove,
+    metadata, wc) plancollation() would without counting and sorting the
+    headers. Returns (plan, pagetable): plan is None whenever the full scan
+    has to decide, and pagetable is the table built, if one was, for the
+    full scan to use.
+
+    The sample alone can't decide: the full scan strips any candidate that
+    recurs anywhere in a header-less volume, so a plan made from the sample
+    left such lines on their pages. With every candidate checked, remove is
+    always empty and the output is the same as the full scan's.
+    '''
+    indices = sampleindices(len(pagelist))
+    if indices is None:
+        return None, None
+
+    with stage(timer, 'sample'):
+        headers = [pageheader(pagelist[idx], header_lines)[0] for idx in indices]
+        headerdict = Counter(header for header in headers if header != '')
+        if len(headerdict) == 0 or max(headerdict.values()) > 1:
+            return None, None
+
+    with stage(timer, 'headers'):
+        pagetable = PageTable(countlines(pagelist, timer), header_lines)
+
+    ## The same test as plancollation(), blank candidates included.
+    with stage(timer, 'sample'):
+        headers = pagetable.headers
+        blanks = headers.count('')
+        distinct = len(set(headers))
+        if (distinct - (blanks > 0) < len(headers) - blanks
+                or len(headers) / distinct > header_cutoff):
+            return None, pagetable
+
+    wc = sum(pagetable.wordcounts)
+    tally(pagetable, timer)
+    divplace = {0: (len(pagelist) - 1, 'fulltext', wc, 0)}
+    return (divplace, set(), list(), wc), pagetable
+
+def collatepage(idx, page, divplace, remove, closing, include_divs=True):
+    '''
+    Runs one page through the collation loop and returns it. closing maps a
+    page index to the number of </div> tags owed to that page by sections
+    opened on earlier pages. It is updated as sections open and close, so the
+    same dictionary has to be passed in for every page of a volume, in order.
+    '''
+    if idx in closing:
+        page.extend(["</div>\n"] * closing.pop(idx))
+
+    if len(page) > 0:
+        ## References to page[-1] are to remove OCR errors from the bottom of pages
+        ## that can cause tags to be place incorrectly.
+        page[-1] = page[-1].strip()
+        if len(page[-1]) > 0:
+            page[-1] += "\n"
+        else:
+            del page[-1]
+        if include_divs:
+            page.append("<pb>\n")
+        
+        ## Remove empty lines, page numbers, and running headers at the top of a page
+        if len(page) > 1:
+            page = removeheader(remove, page)
+            
+    if include_divs and idx in divplace:
+        page.insert(0, divtag(divplace, idx))
+        end = divplace[idx][0]
+        if end == idx:
+            page.append("</div>\n")
+        else:
+            closing[end] = closing.get(end, 0) + 1
+
+    return page
+
+def divtag(divplace, idx):
+    '''Returns the opening <div> tag for the section that starts on page idx.'''
+    if len(divplace) > 1:
+        return "<div id=\"" + divplace[idx][1] + "\" code=\"" + str(divplace[idx][3]) + "\" wordcount=\"" + str(divplace[idx][2]) + "\">\n"
+    else:
+        return "<div id=\"fulltext\" code=\"" + str(divplace[idx][3]) + "\" wordcount=\"" + str(divplace[idx][2]) + "\">\n"
+
+def collate(pagelist, include_divs=True, header_lines=None, timer=None, headerindex=None,
+            lazy=False, sample=False):
+    '''
+    Accepts a list of pages (each of which is a list of lines) and reads through them,
+    discovering headers (if present) and guessing section divisions based on pairing
+    patterns.  Returns the prepared text, ready for writing to disk (or analysis by
+    functions from other libraries).
+
+    rlmv: MODIFIED: hacked in no_divs to produce collated pages with no tags.
+
+    header_lines caps how far down each page the running header is looked for
+    (see PageTable); the default looks at every line. timer is an optional
+    timing.StageTimer that gets the time spent in each stage and the volume's
+    page, line, word and distinct header counts. headerindex is an optional
+    HeaderIndex of header categories already known for this volume's serial
+    (see headercache); it is updated with this volume's headers.
+
+    With lazy=True, pagelist is left as it is and a CollatedVolume is returned
+    instead of the tuple; it renders the collated text (with or without tags,
+    whatever include_divs says) only when asked.
+
+    With sample=True, volumes that a sample of their pages shows to have no
+    running headers skip counting and sorting the headers (see sampleplan);
+    the output is the same.
+    '''
+    plan = pagetable = None
+    if sample:
+        plan, pagetable = sampleplan(pagelist, header_lines, timer)
+
+    if plan is None:
+        if pagetable is None:
+            with stage(timer, 'headers'):
+                pagetable = PageTable(countlines(pagelist, timer), header_lines)
+
+        plan = plancollation(pagetable, timer, headerindex)
+        tally(pagetable, timer)
+    del pagetable
+    divplace, remove, metadata, wc = plan
+
+    if lazy:
+        return CollatedVolume(pagelist, divplace, remove, metadata, wc)
         
     ## COLLATION LOOP        
     ## Now go through the text, page by page.  If the page number matches that
@@ -605,35 +1209,190 @@ def collate(pagelist, include_divs=True):
     ## If so, remove line with page number and check 2nd line for header.
     ## Without this check, some running headers will not be removed.
     
-    for idx,page in enumerate(pagelist):
-        if len(page) > 0:
-            ## References to page[-1] are to remove OCR errors from the bottom of pages
-            ## that can cause tags to be place incorrectly.
-            page[-1] = page[-1].strip()
-            if len(page[-1]) > 0:
-                page[-1] += "\n"
-            else:
-                del page[-1]
-            if include_divs:
-                page.append("<pb>\n")
-            
-            ## Recursive algorithm that will remove empty lines, page numbers, and running headers at the top of a page
-            if len(page) > 1:
-                try:
-                    pagelist[idx] = removeheader(remove, page)
-                except RuntimeError: ## recursion depth error
-                    pagelist[idx] = pagelist[idx]
-                
-        if include_divs and idx in divplace:
-            if len(divplace) > 1:
-                page.insert(0,"<div id=\"" + divplace[idx][1] + "\" code=\"" + str(divplace[idx][3]) + "\" wordcount=\"" + str(divplace[idx][2]) + "\">\n")
-            else:
-                page.insert(0,"<div id=\"fulltext\" code=\"" + str(divplace[idx][3]) + "\" wordcount=\"" + str(divplace[idx][2]) + "\">\n")
-            pagelist[divplace[idx][0]].append("</div>\n")
-            
+    closing = {}
+    with stage(timer, 'collation'):
+        for idx,page in enumerate(pagelist):
+            pagelist[idx] = collatepage(idx, page, divplace, remove, closing, include_divs)
     
     return pagelist, len(divplace), metadata, wc
 
     ## We're returning the length of the divplace dictionary in order to indicate the number of
     ## divisions in this document.
 
+class CollatedVolume:
+    '''
+    A collated volume that hasn't been written out yet: references to the
+    original pages, the plan plancollation() made for them, and, once a page
+    has been rendered, the number of lines taken off its top. Nothing is
+    copied or changed in the pages; each renderer produces its output a page
+    at a time, as it is asked for.
+
+    tagged() and plain() yield the pages collate() would return with and
+    without include_divs, sections() yields each section's plain pages, and
+    json() describes the volume (and, optionally, its text) as JSON.
+    '''
+
+    __slots__ = ('pages', 'divplace', 'remove', 'metadata', 'wc', 'removed')
+
+    def __init__(self, pages, divplace, remove, metadata, wc):
+        self.pages = pages
+        self.divplace = divplace
+        self.remove = remove
+        self.metadata = metadata
+        self.wc = wc
+        ## Lines removeheader() takes off each page, keyed by include_divs.
+        self.removed = {}
+
+    def __len__(self):
+        return len(self.pages)
+
+    @property
+    def numberofdivs(self):
+        return len(self.divplace)
+
+    def astuple(self, include_divs=True):
+        '''Returns (pages, numberofdivs, metadata, wc), as collate() does.'''
+        pages = self.tagged() if include_divs else self.plain()
+        return list(pages), len(self.divplace), self.metadata, self.wc
+
+    def closings(self):
+        '''
+        Returns a dictionary from page index to the number of </div> tags
+        collatepage() appends to the top of that page's tail: one for every
+        section that opens on an earlier page and ends on it.
+        '''
+        closing = {}
+        for start, (end, name, words, code) in self.divplace.items():
+            if start < end < len(self.pages):
+                closing[end] = closing.get(end, 0) + 1
+        return closing
+
+    def render(self, idx, include_divs=True, closing=0):
+        '''
+        Returns page idx as collatepage() would leave it. closing is the
+        number of </div> tags owed to the page (see closings()).
+        '''
+        page = self.pages[idx]
+        tail = ["</div>\n"] * closing
+        body = len(page)
+        last = []
+
+        ## The bottom line is cleaned up unless closing tags now end the page.
+        if closing == 0 and body > 0:
+            body -= 1
+            line = page[body].strip()
+            if len(line) > 0:
+                last = [line + "\n"]
+
+        lines = []
+        if len(page) + closing > 0:
+            if include_divs:
+                tail.append("<pb>\n")
+            counts = self.removed.setdefault(include_divs, {})
+            if idx not in counts:
+                count = 0
+                if body + len(last) + len(tail) > 1:
+                    count = headerlines(self.remove, chain(islice(page, body), last, tail))
+                counts[idx] = count
+            lines = list(islice(chain(islice(page, body), last, tail), counts[idx], None))
+
+        if include_divs and idx in self.divplace:
+            lines.insert(0, divtag(self.divplace, idx))
+            if self.divplace[idx][0] == idx:
+                lines.append("</div>\n")
+        return lines
+
+    def tagged(self):
+        '''Yields the pages with <pb> and <div> tags, as collate() returns them.'''
+        closing = self.closings()
+        for idx in range(len(self.pages)):
+            yield self.render(idx, True, closing.get(idx, 0))
+
+    def plain(self):
+        '''Yields the cleaned pages without tags, as collate(include_divs=False) does.'''
+        for idx in range(len(self.pages)):
+            yield self.render(idx, False)
+
+    def sections(self):
+        '''
+        Yields (name, wordcount, (first page, last page), pages) for each
+        section in order, where pages is a generator of the section's plain
+        pages.
+        '''
+        for start in sorted(self.divplace):
+            end, name, words, code = self.divplace[start]
+            if len(self.divplace) == 1:
+                name = 'fulltext'
+            pages = (self.render(idx, False)
+                     for idx in range(start, min(end, len(self.pages) - 1) + 1))
+            yield name, words, (start, end), pages
+
+    def json(self, text=False):
+        '''
+        Returns the volume's section table as a JSON string. With text=True
+        each section also carries its plain text.
+        '''
+        sections = []
+        for name, words, (start, end), pages in self.sections():
+            section = {'id': name, 'wordcount': words, 'firstpage': start, 'lastpage': end}
+            if text:
+                section['text'] = ''.join(chain.from_iterable(pages))
+            sections.append(section)
+        return json.dumps({'divs': len(self.divplace), 'wordcount': self.wc,
+                           'pages': len(self.pages), 'sections': sections})
+
+def streamcollate(openpages, include_divs=True, header_lines=None, timer=None,
+                    pagetable=None, headerindex=None):
+    '''
+    A two-pass version of collate() for volumes too large to hold in memory.
+    openpages is a callable that returns a fresh iterable of pages (each a
+    list of lines) every time it is called; it is called twice. The first pass
+    keeps only the PageTable of header candidates and word counts. Returns
+    (pages, numberofdivs, metadata, wc) like collate(), except that pages is a
+    generator that re-reads the volume and yields each page as it is collated.
+    The collated text is the same as collate() would produce.
+
+    If the caller can build the PageTable more cheaply than by decoding every
+    page (see pagesource.VolumeSource), it can pass it in as pagetable and
+    openpages is then only called once. headerindex is as for collate().
+    '''
+    if pagetable is None:
+        with stage(timer, 'headers'):
+            pagetable = PageTable(countlines(openpages(), timer), header_lines)
+
+    divplace, remove, metadata, wc = plancollation(pagetable, timer, headerindex)
+    tally(pagetable, timer)
+    del pagetable
+
+    def collated():
+        closing = {}
+        for idx, page in enumerate(openpages()):
+            with stage(timer, 'collation'):
+                page = collatepage(idx, page, divplace, remove, closing, include_divs)
+            yield page
+
+    return collated(), len(divplace), metadata, wc
+
+## Helpers for the optional timing.StageTimer, so the collation code reads the
+## same whether or not a run is being timed.
+
+def stage(timer, name):
+    if timer is None:
+        return nullcontext()
+    return timer.stage(name)
+
+def countlines(pages, timer):
+    if timer is None:
+        return pages
+    return _countlines(pages, timer)
+
+def _countlines(pages, timer):
+    for page in pages:
+        timer.count('lines', len(page))
+        yield page
+
+def tally(pagetable, timer):
+    if timer is not None:
+        timer.count('pages', len(pagetable))
+        timer.count('words', sum(pagetable.wordcounts))
+        timer.count('headers', len(set(pagetable.headers)))
@@ -10,6 +10,10 @@ DictDirectory = "dictionaries/"
 
 TabChar="\t"
 
+## Endings of collated text files, for PairtreeIndex to look for beside each
+## zip: plain, gzip and lzma (see outputwriter.compressions).
+OutputSuffixes = ('.txt', '.txt.gz', '.txt.xz')
+
 def loadpathdictionary(path_to=""):
     '''Some of these scripts may eventually be exported for the use of
     other researchers grappling with HathiTrust data. Both for them, and
@@ -81,3 +85,126 @@ def putpath(newpathID, newpath):
             outline = newpathID + '\t' + newpath + '\n'
             file.write(outline)
         
+
+def pairtreedecode(name):
+    ''' Turns a cleaned pairtree object name back into the id it stands for,
+    undoing the character substitutions ('+' for ':', '=' for '/', ',' for
+    '.') and the ^xx hex escapes of the pairtree spec.'''
+
+    name = name.replace('+', ':').replace('=', '/').replace(',', '.')
+    if '^' not in name:
+        return name
+    decoded = bytearray()
+    idx = 0
+    while idx < len(name):
+        if name[idx] == '^' and idx + 2 < len(name):
+            decoded += bytes.fromhex(name[idx + 1: idx + 3])
+            idx += 3
+        else:
+            decoded += name[idx].encode('utf-8')
+            idx += 1
+    return decoded.decode('utf-8')
+
+class PairtreeIndex:
+    ''' An in-memory index from HathiTrust volume id to the (zip path, size,
+    mtime) of its zip, built by walking a collection root once with
+    os.scandir instead of working out and probing a path per volume. Ids are
+    read back from the directory names, so ids with internal slashes, colons
+    and periods resolve however they were cleaned on disk.
+
+    The scan also notes which collated .txt files (plain or compressed) sit
+    beside each zip, so bigcollate can skip finished volumes without
+    looking for their output one by one. That is only as fresh as the
+    scan: output written since is not in the index.
+
+    The index can be saved as a tab-delimited file and loaded again, so a
+    large collection only has to be walked once.'''
+
+    def __init__(self, rootpath, entries=None, outputs=None):
+        self.rootpath = rootpath
+        self.entries = {} if entries is None else entries
+        self.outputs = {} if outputs is None else outputs
+
+    @classmethod
+    def scan(cls, rootpath):
+        ''' Walks every <prefix>/pairtree_root/ tree under rootpath.'''
+        index = cls(rootpath)
+        with os.scandir(rootpath) as namespaces:
+            for namespace in namespaces:
+                pairtreeroot = os.path.join(namespace.path, 'pairtree_root')
+                if namespace.is_dir() and os.path.isdir(pairtreeroot):
+                    index._scan(namespace.name, pairtreeroot)
+        return index
+
+    def _scan(self, prefix, directory):
+        zips = []
+        texts = []
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    self._scan(prefix, entry.path)
+                elif entry.name.endswith('.zip'):
+                    zips.append(entry)
+                elif entry.name.endswith(OutputSuffixes):
+                    texts.append(entry.name)
+        for entry in zips:
+            stat = entry.stat()
+            stem = entry.name[:-4]
+            htid = prefix + '.' + pairtreedecode(stem)
+            self.entries[htid] = (entry.path, stat.st_size, stat.st_mtime)
+            ## The same files bigcollate would glob for: stem*.txt and so on.
+            self.outputs[htid] = tuple(suffix for suffix in OutputSuffixes
+                                       if any(name.startswith(stem) and name.endswith(suffix)
+                                              for name in texts))
+
+    @classmethod
+    def load(cls, path):
+        ''' Reads an index written by save().'''
+        with open(path, encoding='utf-8') as file:
+            rootpath = file.readline().rstrip('\n')
+            entries = {}
+            outputs = {}
+            for line in file:
+                fields = line.rstrip('\n').split(TabChar)
+                htid, zippath, size, mtime = fields[:4]
+                entries[htid] = (zippath, int(size), float(mtime))
+                ## Indexes saved before outputs were recorded have four fields.
+                if len(fields) > 4:
+                    outputs[htid] = tuple(fields[4].split())
+        return cls(rootpath, entries, outputs)
+
+    def save(self, path):
+        ''' Writes the index as a tab-delimited file: the collection root on
+        the first line, then one line per volume, ending with the output
+        suffixes found beside its zip. The file is written under a
+        temporary name and renamed, so a reader never sees half an index.'''
+        temppath = path + '.tmp'
+        with open(temppath, 'w', encoding='utf-8') as file:
+            file.write(self.rootpath + '\n')
+            for htid, (zippath, size, mtime) in self.entries.items():
+                line = htid + TabChar + zippath + TabChar + str(size) + TabChar + repr(mtime)
+                if htid in self.outputs:
+                    line += TabChar + ' '.join(self.outputs[htid])
+                file.write(line + '\n')
+        os.replace(temppath, path)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, htid):
+        return htid in self.entries
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def get(self, htid):
+        ''' Returns (zip path, size, mtime) for htid, or None.'''
+        return self.entries.get(htid)
+
+    def hasoutput(self, htid, suffix='.txt'):
+        ''' Returns whether a collated text file ending in suffix was beside
+        htid's zip when the collection was scanned, or None if the index
+        doesn't say (htid isn't in it, or it was loaded from an older file).'''
+        if htid not in self.outputs:
+            return None
+        return suffix in self.outputs[htid]
@@ -0,0 +1,140 @@
+'''
+    A persistent cache of running-header clusters shared across the volumes
+    of a serial.
+
+    Volumes of the same serial carry the same running headers volume after
+    volume. The cache keeps, for each serial (or record) id, the normalized
+    headers that earned their place in earlier volumes, and hands them back as
+    a collator3.HeaderIndex to seed segment() with. Headers of a new volume
+    that match a known cluster are normalized to it straight away, and the
+    serial's sections get the same labels from one volume to the next.
+
+    Only headers found on at least pair_cutoff pages of a volume are kept
+    (never the blank header of pages without one),
+    each serial holds at most maxclusters of them (the ones seen on the most
+    pages), and once more than maxserials serials are cached the least
+    recently used are dropped. Bigram sets are rebuilt from the header text
+    with encodebigrams() when a serial is loaded, so only the text is stored.
+
+    A volume is seeded with whatever earlier volumes of its serial have
+    stored by the time it starts, so the volumes of a serial have to be
+    collated in order, by one process, for the output to be reproducible.
+    bigcollate refuses a header cache with workers > 1, and a sharded run
+    keeps every serial in one shard (see bigcollate.readids). Updates that
+    do come from several processes at once are merged, never lost.
+'''
+
+import sqlite3
+import time
+
+from . import collator3
+
+
+class HeaderClusterCache:
+    '''
+    Opens (creating if necessary) the cluster cache database at path. As with
+    ResultCache, the connection is opened on first use and dropped when the
+    cache is pickled, so pool workers each open their own.
+    '''
+
+    def __init__(self, path, maxserials=10000, maxclusters=64):
+        self.path = path
+        self.maxserials = maxserials
+        self.maxclusters = maxclusters
+        self._connection = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_connection'] = None
+        return state
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, timeout=60)
+            self._connection.execute('''CREATE TABLE IF NOT EXISTS serials (
+                                        serial TEXT PRIMARY KEY,
+                                        used REAL NOT NULL)''')
+            self._connection.execute('''CREATE INDEX IF NOT EXISTS serials_used
+                                        ON serials (used)''')
+            self._connection.execute('''CREATE TABLE IF NOT EXISTS clusters (
+                                        serial TEXT NOT NULL,
+                                        position INTEGER NOT NULL,
+                                        header TEXT NOT NULL,
+                                        pages INTEGER NOT NULL,
+                                        PRIMARY KEY (serial, position))''')
+            self._connection.commit()
+        return self._connection
+
+    def _clusters(self, serial):
+        ## Caches written before blank headers were left out may hold one.
+        return self.connection.execute(
+            '''SELECT header, pages FROM clusters WHERE serial = ? AND header != ''
+               ORDER BY position''', (serial,)).fetchall()
+
+    def headers(self, serial):
+        '''Returns the known headers of serial, in the order they were found.'''
+        return [header for header, pages in self._clusters(serial)]
+
+    def index(self, serial):
+        '''Returns a HeaderIndex seeded with the known headers of serial.'''
+        return collator3.HeaderIndex(self.headers(serial))
+
+    def update(self, serial, index, seeds):
+        '''
+        Folds what segment() found in a volume of serial back into the cache.
+        index is the HeaderIndex the volume was collated with, and seeds the
+        number of headers it was seeded with (the first seeds codes).
+        '''
+        ## Pool workers may be updating the same serial at once, so the
+        ## clusters are read and rewritten in one write transaction, and
+        ## this volume's headers are added to whatever is stored by then
+        ## (which holds more than its seeds if another volume got in first).
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            clusters = [list(cluster) for cluster in self._clusters(serial)]
+            positions = {header: position for position, (header, pages) in enumerate(clusters)}
+            for code, (header, bigramdex) in enumerate(index.valid_headers):
+                pages = index.pagecounts[code]
+                ## Pages without a header candidate share the blank header,
+                ## which is no header text to seed anything with.
+                if header == '' or (code >= seeds and pages < collator3.pair_cutoff):
+                    continue
+                if header in positions:
+                    clusters[positions[header]][1] += pages
+                else:
+                    positions[header] = len(clusters)
+                    clusters.append([header, pages])
+
+            ## Keep the clusters seen on the most pages, in their original order,
+            ## so the codes segment() hands out stay in the same sequence.
+            if len(clusters) > self.maxclusters:
+                keep = sorted(range(len(clusters)), key = lambda idx: clusters[idx][1],
+                              reverse = True)[:self.maxclusters]
+                clusters = [clusters[idx] for idx in sorted(keep)]
+
+            self.connection.execute("DELETE FROM clusters WHERE serial = ?", (serial,))
+            self.connection.executemany(
+                "INSERT INTO clusters VALUES (?, ?, ?, ?)",
+                [(serial, position, header, pages)
+                 for position, (header, pages) in enumerate(clusters)])
+            self.connection.execute("INSERT OR REPLACE INTO serials VALUES (?, ?)",
+                                    (serial, time.time()))
+        self.evict(self.maxserials)
+
+    def evict(self, maxserials):
+        '''Drops the least recently used serials beyond maxserials.'''
+        with self.connection:
+            excess = self.connection.execute(
+                "SELECT COUNT(*) FROM serials").fetchone()[0] - maxserials
+            if excess <= 0:
+                return
+            stale = self.connection.execute(
+                "SELECT serial FROM serials ORDER BY used LIMIT ?", (excess,)).fetchall()
+            self.connection.executemany("DELETE FROM clusters WHERE serial = ?", stale)
+            self.connection.executemany("DELETE FROM serials WHERE serial = ?", stale)
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
@@ -0,0 +1,96 @@
+'''
+    A persistent record of which volumes a bigcollate run has finished, so a
+    restarted run can skip them without probing the pairtree for output files.
+
+    The manifest is a small SQLite database with one row per HTid holding the
+    outcome of its last run ('done', 'failed' or 'missing'), the size and
+    modification time of the input zip, and a checksum of the collated text.
+'''
+
+import sqlite3
+import time
+
+
+class Manifest:
+    '''
+    Opens (creating if necessary) the manifest database at path. Records are
+    committed in batches of batchsize so that writing the manifest doesn't
+    cost a disk sync per volume; close() commits whatever is left.
+    '''
+
+    def __init__(self, path, batchsize=100):
+        self.path = path
+        self.batchsize = batchsize
+        self.pending = 0
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS volumes (
+                                    htid TEXT PRIMARY KEY,
+                                    status TEXT NOT NULL,
+                                    zipsize INTEGER,
+                                    zipmtime REAL,
+                                    checksum TEXT,
+                                    updated REAL)''')
+        self.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def completed(self):
+        '''
+        Returns a dictionary mapping every HTid recorded as done to the
+        (zipsize, zipmtime) its zip had when it was collated.
+        '''
+        rows = self.connection.execute(
+            "SELECT htid, zipsize, zipmtime FROM volumes WHERE status = 'done'")
+        return {HTid: (zipsize, zipmtime) for HTid, zipsize, zipmtime in rows}
+
+    def status(self, HTid):
+        '''Returns the recorded status for HTid, or None if it has never run.'''
+        row = self.connection.execute(
+            "SELECT status FROM volumes WHERE htid = ?", (HTid,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def counts(self):
+        '''Returns a dictionary mapping each status to the number of volumes with it.'''
+        return dict(self.connection.execute(
+            "SELECT status, COUNT(*) FROM volumes GROUP BY status"))
+
+    def merge(self, path):
+        '''
+        Copies in the records of the manifest at path, as written by another
+        shard of a run. Where both have a record for an HTid, the more recent
+        one is kept.
+        '''
+        self.commit()
+        self.connection.execute("ATTACH DATABASE ? AS other", (path,))
+        try:
+            with self.connection:
+                self.connection.execute(
+                    '''INSERT OR REPLACE INTO volumes
+                       SELECT * FROM other.volumes AS theirs WHERE NOT EXISTS (
+                           SELECT 1 FROM main.volumes AS ours
+                           WHERE ours.htid = theirs.htid AND ours.updated >= theirs.updated)''')
+        finally:
+            self.connection.execute("DETACH DATABASE other")
+
+    def record(self, HTid, status, zipsize=None, zipmtime=None, checksum=None):
+        '''Records the outcome of collating HTid, replacing any earlier record.'''
+        self.connection.execute(
+            "INSERT OR REPLACE INTO volumes VALUES (?, ?, ?, ?, ?, ?)",
+            (HTid, status, zipsize, zipmtime, checksum, time.time()))
+        self.pending += 1
+        if self.pending >= self.batchsize:
+            self.commit()
+
+    def commit(self):
+        self.connection.commit()
+        self.pending = 0
+
+    def close(self):
+        self.commit()
+        self.connection.close()
@@ -0,0 +1,101 @@
+'''
+    Atomic, buffered output files for bigcollate.
+
+    An AtomicWriter writes to a temporary file next to its target and renames
+    it into place only once everything has been written, so an interrupted run
+    never leaves a half-written .txt or .meta behind for the next run (or a
+    downstream job) to mistake for finished output. Writes go through one large
+    buffer, and the collated text can optionally be compressed with gzip or
+    lzma on the way out.
+'''
+
+import gzip
+import lzma
+import os
+import tempfile
+
+## File name suffix for each supported compression.
+compressions = {None: '', 'gzip': '.gz', 'lzma': '.xz'}
+
+## Size of the write buffer, in bytes.
+buffersize = 1 << 20
+
+## The process umask, read once at import: os.umask() can only be read by
+## setting it, which isn't safe to do while other threads create files.
+umask = os.umask(0)
+os.umask(umask)
+
+
+def compressedpath(path, compression=None):
+    '''Returns path with the suffix for compression added.'''
+    if compression not in compressions:
+        raise ValueError("unknown compression {!r}; use one of {}".format(
+                            compression, sorted(filter(None, compressions))))
+    return path + compressions[compression]
+
+
+class AtomicWriter:
+    '''
+    A binary file that appears at path only when it is closed without error.
+    Used as a context manager; if the with block raises, the temporary file is
+    removed and whatever was at path before is left alone. compression is
+    None, 'gzip' or 'lzma', and is applied to everything written.
+    '''
+
+    def __init__(self, path, compression=None):
+        compressedpath(path, compression)
+        self.path = path
+        directory, name = os.path.split(path)
+        handle, self.temppath = tempfile.mkstemp(prefix='.' + name + '.', suffix='.tmp',
+                                                 dir=directory or '.')
+        self.raw = os.fdopen(handle, mode='wb', buffering=buffersize)
+        if compression == 'gzip':
+            ## mtime=0 keeps the output (and so the result cache) deterministic.
+            self.file = gzip.GzipFile(filename='', mode='wb', fileobj=self.raw, mtime=0)
+        elif compression == 'lzma':
+            self.file = lzma.LZMAFile(self.raw, mode='wb')
+        else:
+            self.file = self.raw
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exctype, exc, traceback):
+        if exctype is None:
+            self.commit()
+        else:
+            self.abort()
+
+    def write(self, data):
+        return self.file.write(data)
+
+    def writelines(self, chunks):
+        self.file.writelines(chunks)
+
+    def commit(self):
+        '''Finishes the file and renames it into place.'''
+        if self.file is not self.raw:
+            self.file.close()
+        self.raw.close()
+        ## mkstemp creates the file readable by its owner only; give it the
+        ## permissions a plain open() would have.
+        os.chmod(self.temppath, 0o666 & ~umask)
+        os.replace(self.temppath, self.path)
+
+    def abort(self):
+        '''Throws away everything written.'''
+        try:
+            if self.file is not self.raw:
+                self.file.close()
+            self.raw.close()
+        finally:
+            try:
+                os.remove(self.temppath)
+            except FileNotFoundError:
+                pass
+
+
+def atomicwrite(path, data, compression=None):
+    '''Writes bytes to path in one call, atomically.'''
+    with AtomicWriter(path, compression) as file:
+        file.write(data)
@@ -0,0 +1,163 @@
+'''
+    Lazy page loading from volume zips.
+
+    A VolumeSource opens a volume zip (or wraps zip bytes already in memory)
+    and decompresses page members only when they are asked for. Page
+    members are picked by name -- the .txt files in the zip, in sorted order --
+    rather than by dropping the first entry of the namelist, so zips without a
+    folder entry lose no pages.
+
+    For the first pass of a streamed collation, pagetable() works out each
+    page's header candidate and word count without decoding whole pages where
+    it can: word counts are taken straight from the UTF-8 bytes, and only the
+    first few lines of each page are decoded to look for the header. Full
+    decoding is left to the second pass, when the page is written out.
+'''
+
+import re
+from io import BytesIO
+from operator import methodcaller
+from time import perf_counter
+from zipfile import ZipFile
+
+from .collator3 import Page, PageTable, headerline, headertext, pagewordcount
+
+## Zip members that hold page text.
+pagepattern = re.compile(r'\.txt$')
+
+## Bytes decoded up front when looking for a page's running header. Anything
+## past the last newline in this window is only decoded if no header turns up.
+headerwindow = 2048
+
+## Every character str.split() treats as whitespace that bytes.split() does
+## not, as it appears in UTF-8. Pages without any of these have the same
+## number of words whether they are split as bytes or as text.
+unicodespace = re.compile(rb'[\x1c-\x1f]|\xc2[\x85\xa0]|\xe1\x9a\x80|'
+                          rb'\xe2\x80[\x80-\x8a\xa8\xa9\xaf]|\xe2\x81\x9f|\xe3\x80\x80')
+
+## The line breaks str.splitlines() knows besides \n that unicodespace
+## doesn't already catch.
+linebreaks = re.compile(rb'[\r\x0b\x0c]')
+
+
+def linecount(data):
+    '''
+    Returns the number of lines str.splitlines() finds in page bytes that
+    unicodespace doesn't match, decoding them only if they hold a line
+    break other than a newline.
+    '''
+    if linebreaks.search(data) is not None:
+        return len(data.decode('utf-8', 'replace').splitlines())
+    return data.count(b'\n') + (len(data) > 0 and not data.endswith(b'\n'))
+
+
+class VolumeSource:
+    '''
+    Pages of one volume zip. source is the path to the zip or its contents as
+    bytes. errors is passed to bytes.decode(). timer is an optional
+    timing.StageTimer that gets the time spent reading and decoding (and
+    is told when a page fails to read or decode). With
+    compact=True pages are decoded as collator3.Page objects rather than
+    lists of lines.
+    '''
+
+    def __init__(self, source, errors='strict', pattern=pagepattern, timer=None,
+                 compact=False):
+        self.errors = errors
+        self.timer = timer
+        self.split = Page.fromtext if compact else methodcaller('splitlines', True)
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            source = BytesIO(source)
+        self.zipvol = ZipFile(source, mode='r')
+        self.members = sorted(name for name in self.zipvol.namelist()
+                                if not name.endswith('/') and pattern.search(name))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self.members)
+
+    def read(self, idx):
+        '''Returns the raw bytes of page idx.'''
+        if self.timer is None:
+            return self.zipvol.read(self.members[idx])
+        start = perf_counter()
+        try:
+            data = self.zipvol.read(self.members[idx])
+        except BaseException:
+            self.timer.fail('read')
+            raise
+        self.timer.add('read', perf_counter() - start)
+        return data
+
+    def decode(self, data):
+        '''Decodes page bytes into a list of lines (or a Page).'''
+        if self.timer is None:
+            return self.split(data.decode('utf-8', self.errors))
+        start = perf_counter()
+        try:
+            lines = self.split(data.decode('utf-8', self.errors))
+        except BaseException:
+            self.timer.fail('decode')
+            raise
+        self.timer.add('decode', perf_counter() - start)
+        return lines
+
+    def page(self, idx):
+        '''Returns page idx as a list of lines (or a Page).'''
+        return self.decode(self.read(idx))
+
+    def pages(self):
+        '''Yields every page in order, each as a list of lines (or a Page).'''
+        for idx in range(len(self.members)):
+            yield self.page(idx)
+
+    def pagetable(self, header_lines=None):
+        '''
+        Builds the volume's collator3.PageTable, decoding as little of each
+        page as it can. The table is the same as PageTable(self.pages()), and
+        the timer is given the number of lines of each page all the same.
+        '''
+        pagetable = PageTable(header_lines=header_lines)
+        for idx in range(len(self.members)):
+            pagetable.append(*self.features(self.read(idx), header_lines))
+        return pagetable
+
+    def features(self, data, header_lines=None):
+        '''Returns (header, numeric score, word count) for page bytes.'''
+        ## Bytes and text split into the same words unless the page has
+        ## Unicode whitespace, or undecodable bytes are going to be dropped.
+        if unicodespace.search(data) is not None or self.errors not in ('strict', 'replace'):
+            lines = self.decode(data)
+            if self.timer is not None:
+                self.timer.count('lines', len(lines))
+            idx, score = headerline(lines, header_lines)
+            return headertext(lines, idx), score, pagewordcount(lines)
+
+        ## The timing record counts lines as collator3.countlines does.
+        if self.timer is not None:
+            self.timer.count('lines', linecount(data))
+        words = len(data.split())
+        cut = data.rfind(b'\n', 0, headerwindow)
+        if len(data) <= headerwindow or cut < 0:
+            lines = self.decode(data)
+            idx, score = headerline(lines, header_lines)
+            return headertext(lines, idx), score, words
+
+        ## Cutting just after a newline never splits a character or a line
+        ## ending, so these are exactly the page's first lines. The answer
+        ## stands if the header is among them, or if they already cover
+        ## header_lines lines; otherwise look at the whole page after all.
+        lines = self.decode(data[:cut + 1])
+        idx, score = headerline(lines, header_lines)
+        if idx < 0 and (header_lines is None or len(lines) < header_lines):
+            lines = self.decode(data)
+            idx, score = headerline(lines, header_lines)
+        return headertext(lines, idx), score, words
+
+    def close(self):
+        self.zipvol.close()
@@ -0,0 +1,185 @@
+'''
+    A threaded read-ahead and write-behind pipeline for bigcollate.
+
+    Collating is CPU work, but a single bigcollate process also spends a good
+    part of each volume waiting on the disk: first for the zip to be read and
+    then for the .txt and .meta to be written. On slow (USB or network)
+    volumes that wait can rival the collation itself. A Pipeline overlaps the
+    three: a reader thread reads the zips of the next few volumes into memory,
+    the calling thread collates, and a writer thread writes finished volumes
+    out. Both queues are bounded, so at most depth volumes are held in memory
+    on either side.
+
+    The pipeline keeps count of where time goes, so its depth can be sized:
+    if collation mostly waits on reads, the disk is the bottleneck and a
+    deeper queue won't help much; if the reader is mostly blocked on a full
+    queue, reads are keeping up with room to spare.
+'''
+
+import queue
+import threading
+import time
+
+from .outputwriter import atomicwrite
+
+## Marks the end of the jobs on a queue.
+_end = object()
+
+
+class PendingWrites:
+    '''
+    The output of one volume, as collatevolume() hands it to the writer
+    thread: files to write, and functions to call once they are written
+    (storing the files in the result cache, say).
+    '''
+
+    def __init__(self):
+        self.files = []
+        self.callbacks = []
+
+    def write(self, path, data, compression=None):
+        '''Queues bytes to be written to path, atomically (see outputwriter).'''
+        self.files.append((path, data, compression))
+
+    def clear(self):
+        '''Forgets everything queued so far, for a volume being collated again.'''
+        self.files.clear()
+        self.callbacks.clear()
+
+    def after(self, function):
+        '''Queues a function to call, without arguments, once the files are written.'''
+        self.callbacks.append(function)
+
+
+class Pipeline:
+    '''
+    Runs jobs through a reader thread, the calling thread and a writer
+    thread, with at most depth jobs waiting between each of them.
+    '''
+
+    def __init__(self, depth=4):
+        self.depth = depth
+        self.readq = queue.Queue(depth)
+        self.writeq = queue.Queue(depth)
+        self.doneq = queue.Queue()
+        self.count = 0
+        ## Seconds spent waiting, by who waited for what.
+        self.stalls = {'collate waiting on reads': 0.0,
+                       'collate waiting on writes': 0.0,
+                       'reader blocked on full queue': 0.0,
+                       'writer idle': 0.0}
+        ## Queue lengths as seen by the collating thread: [total, samples, peak].
+        self.depths = {'read queue': [0, 0, 0], 'write queue': [0, 0, 0]}
+        self.readerror = None
+
+    def _wait(self, stall, function, *args):
+        started = time.perf_counter()
+        result = function(*args)
+        self.stalls[stall] += time.perf_counter() - started
+        return result
+
+    def _sample(self, name, size):
+        depth = self.depths[name]
+        depth[0] += size
+        depth[1] += 1
+        depth[2] = max(depth[2], size)
+
+    def _read(self, jobs, prefetch):
+        try:
+            for job in jobs:
+                try:
+                    data = prefetch(job)
+                except Exception:
+                    ## The collating thread reads the volume itself, and
+                    ## reports whatever went wrong.
+                    data = None
+                self._wait('reader blocked on full queue', self.readq.put, (job, data))
+        except Exception as err:
+            self.readerror = err
+        finally:
+            self.readq.put(_end)
+
+    def _write(self):
+        while True:
+            item = self._wait('writer idle', self.writeq.get)
+            if item is _end:
+                self.doneq.put(_end)
+                return
+            result, writes = item
+            error = None
+            try:
+                for path, data, compression in writes.files:
+                    atomicwrite(path, data, compression)
+            except Exception as err:
+                error = err
+            self.doneq.put((result, writes, error))
+
+    def _finish(self, result, writes, error):
+        HTid, status, message, info = result
+        if error is None:
+            try:
+                for function in writes.callbacks:
+                    function()
+                return result
+            except Exception as err:
+                error = err
+        ## Only the input went right, so that is all the manifest gets.
+        info = {key: info[key] for key in ('zipsize', 'zipmtime') if key in info}
+        return HTid, 'failed', "{} error: {!r}".format(HTid, error), info
+
+    def run(self, jobs, prefetch, process):
+        '''
+        Yields process(job, prefetch(job), writes) for each job in order,
+        once everything the call queued on writes (a PendingWrites) has been
+        written. Results are (HTid, status, message, info) tuples, as from
+        bigcollate._collatejob; a volume whose output can't be written is
+        yielded as failed. prefetch runs in the reader thread and is passed
+        None in place of its result if it raises.
+        '''
+        reader = threading.Thread(target=self._read, args=(jobs, prefetch), daemon=True)
+        writer = threading.Thread(target=self._write, daemon=True)
+        reader.start()
+        writer.start()
+        finished = False
+        try:
+            while True:
+                self._sample('read queue', self.readq.qsize())
+                item = self._wait('collate waiting on reads', self.readq.get)
+                if item is _end:
+                    break
+                job, data = item
+                writes = PendingWrites()
+                result = process(job, data, writes)
+                del data, item
+                if result[1] == 'failed':
+                    writes = PendingWrites()
+                self._wait('collate waiting on writes', self.writeq.put, (result, writes))
+                self._sample('write queue', self.writeq.qsize())
+                self.count += 1
+                while not self.doneq.empty():
+                    yield self._finish(*self.doneq.get())
+
+            self.writeq.put(_end)
+            finished = True
+            while True:
+                item = self.doneq.get()
+                if item is _end:
+                    break
+                yield self._finish(*item)
+            if self.readerror is not None:
+                raise self.readerror
+        finally:
+            if not finished:
+                ## Let the writer finish whatever it was handed.
+                self.writeq.put(_end)
+            writer.join()
+
+    def summary(self):
+        '''Returns a printable report of queue depths and stall times.'''
+        lines = ["Pipeline (depth {}): {} volumes".format(self.depth, self.count)]
+        for stall, seconds in self.stalls.items():
+            lines.append("  {:<30} {:9.2f}s".format(stall, seconds))
+        for name, (total, samples, peak) in self.depths.items():
+            lines.append("  {:<30} mean {:.2f}, max {}".format(
+                            name + " depth", total / samples if samples else 0, peak))
+        return "\n".join(lines)
@@ -0,0 +1,191 @@
+'''
+    A content-addressed cache of collated output, so that re-running the corpus
+    after one ingest batch changes only collates the volumes whose zips did.
+
+    Entries are keyed on a hash of the volume zip, the HTid and the collator
+    settings (see settingskey()). The cached .txt and .meta files live in a
+    local directory, with a small SQLite index recording their size and when
+    each was last used, and a running total of their sizes. When the cache
+    grows past maxbytes, the least recently used entries are evicted.
+'''
+
+import json
+import os
+import shutil
+import sqlite3
+import time
+from hashlib import sha256
+
+from . import collator3
+from .outputwriter import AtomicWriter, buffersize
+
+
+def settingskey(include_divs=True, header_lines=None, compression=None, seeds=None):
+    '''
+    Returns a string describing every setting that changes collated output,
+    for use as part of a cache key. seeds is the list of headers segment() is
+    seeded with from a HeaderClusterCache. compression and seeds only appear
+    in the key when they are set, so entries cached before they existed still
+    match.
+    '''
+    settings = {'dice_cutoff': collator3.dice_cutoff,
+                'header_cutoff': collator3.header_cutoff,
+                'pair_cutoff': collator3.pair_cutoff,
+                'section_cutoff': collator3.section_cutoff,
+                'include_divs': include_divs,
+                'header_lines': header_lines}
+    if compression is not None:
+        settings['compression'] = compression
+    if seeds:
+        settings['seeds'] = seeds
+    return json.dumps(settings, sort_keys=True)
+
+
+def copyfile(source, target):
+    '''
+    Copies source to target through an AtomicWriter, so an interrupted copy
+    never leaves a truncated file at target.
+    '''
+    with open(source, mode='rb') as infile, AtomicWriter(target) as outfile:
+        shutil.copyfileobj(infile, outfile, buffersize)
+
+
+class ResultCache:
+    '''
+    Opens (creating if necessary) the cache in directory. maxbytes bounds the
+    total size of the cached files; None lets the cache grow without limit.
+
+    The SQLite connection is opened on first use and dropped when the cache is
+    pickled, so a ResultCache can be handed to pool workers and each process
+    opens its own connection.
+    '''
+
+    def __init__(self, directory, maxbytes=None):
+        self.directory = directory
+        self.maxbytes = maxbytes
+        self._connection = None
+        os.makedirs(directory, exist_ok=True)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_connection'] = None
+        return state
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            ## Several workers may share the cache, so wait on locks rather
+            ## than failing straight away.
+            self._connection = sqlite3.connect(os.path.join(self.directory, 'index.db'),
+                                                timeout=60)
+            self._connection.execute('''CREATE TABLE IF NOT EXISTS entries (
+                                        key TEXT PRIMARY KEY,
+                                        size INTEGER NOT NULL,
+                                        hasmeta INTEGER NOT NULL,
+                                        checksum TEXT,
+                                        used REAL NOT NULL)''')
+            self._connection.execute('''CREATE INDEX IF NOT EXISTS entries_used
+                                        ON entries (used)''')
+            ## The total size of the entries, kept up to date as they come
+            ## and go so that store() doesn't have to add them all up. A
+            ## cache from before the total was kept gets it worked out once.
+            self._connection.execute('''CREATE TABLE IF NOT EXISTS total (
+                                        size INTEGER NOT NULL)''')
+            with self._connection:
+                self._connection.execute("BEGIN IMMEDIATE")
+                if self._connection.execute("SELECT 1 FROM total").fetchone() is None:
+                    self._connection.execute(
+                        "INSERT INTO total SELECT COALESCE(SUM(size), 0) FROM entries")
+        return self._connection
+
+    def key(self, zipdata, HTid, settings):
+        '''Returns the cache key for a volume's zip bytes, HTid and settings key.'''
+        digest = sha256(zipdata)
+        digest.update(b'\0' + HTid.encode('utf-8') + b'\0' + settings.encode('utf-8'))
+        return digest.hexdigest()
+
+    def _path(self, key, extension):
+        return os.path.join(self.directory, key[:2], key + extension)
+
+    def fetch(self, key, textpath, metapath):
+        '''
+        If key is cached, copies its .txt (and .meta, if one was stored) to
+        textpath and metapath, atomically, and returns the stored checksum of
+        the text.
+        Returns None on a miss.
+        '''
+        row = self.connection.execute(
+            "SELECT hasmeta, checksum FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        hasmeta, checksum = row
+
+        ## The .meta goes first: bigcollate takes the .txt as the sign that
+        ## a volume is finished.
+        try:
+            if hasmeta:
+                copyfile(self._path(key, '.meta'), metapath)
+            copyfile(self._path(key, '.txt'), textpath)
+        except FileNotFoundError:
+            ## Evicted by another process between the lookup and the copy.
+            return None
+
+        with self.connection:
+            self.connection.execute("UPDATE entries SET used = ? WHERE key = ?",
+                                    (time.time(), key))
+        return checksum
+
+    def store(self, key, textpath, metapath=None, checksum=None):
+        '''
+        Copies freshly written output into the cache under key, then evicts
+        the least recently used entries if the cache has outgrown maxbytes.
+        '''
+        os.makedirs(os.path.join(self.directory, key[:2]), exist_ok=True)
+        copyfile(textpath, self._path(key, '.txt'))
+        size = os.path.getsize(textpath)
+        if metapath is not None:
+            copyfile(metapath, self._path(key, '.meta'))
+            size += os.path.getsize(metapath)
+
+        ## Workers share the cache, so the entry and the total change in one
+        ## write transaction.
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            row = self.connection.execute(
+                "SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+            self.connection.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                (key, size, metapath is not None, checksum, time.time()))
+            self.connection.execute("UPDATE total SET size = size + ?",
+                                    (size - (row[0] if row is not None else 0),))
+            total = self.connection.execute("SELECT size FROM total").fetchone()[0]
+
+        if self.maxbytes is not None and total > self.maxbytes:
+            self.evict(self.maxbytes)
+
+    def evict(self, maxbytes):
+        '''Removes least recently used entries until the cache fits in maxbytes.'''
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            total = self.connection.execute("SELECT size FROM total").fetchone()[0]
+            while total > maxbytes:
+                rows = self.connection.execute(
+                    "SELECT key, size FROM entries ORDER BY used LIMIT 64").fetchall()
+                if not rows:
+                    break
+                for key, size in rows:
+                    if total <= maxbytes:
+                        break
+                    for extension in ('.txt', '.meta'):
+                        try:
+                            os.remove(self._path(key, extension))
+                        except FileNotFoundError:
+                            pass
+                    self.connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+                    self.connection.execute("UPDATE total SET size = size - ?", (size,))
+                    total -= size
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
@@ -0,0 +1,132 @@
+'''
+    A corpus-wide SQLite database of section metadata, filled in as bigcollate
+    runs, so questions like "every section over 50,000 words" or "every volume
+    with this running header" are a query instead of a crawl of the .meta files.
+
+    The database has a volumes table (one row per HTid: number of divs, word
+    count, page count) and a sections table with one row per section: its
+    number, running-header pair, word count and first and last page, as in the
+    volume's .meta file. Sections are indexed on HTid, header text and word
+    count.
+'''
+
+import sqlite3
+import time
+
+
+def metasections(metatext):
+    '''
+    Parses the text of a .meta file (see bigcollate.writemeta) into
+    (numberofdivs, wordcount, sections), where sections is a list of
+    (headers, wordcount, firstpage, lastpage) tuples.
+    '''
+    lines = metatext.split("\n")
+    HTid, numberofdivs, wordcount = lines[0].split("\t")
+    sections = []
+    for line in lines[1:]:
+        ## A running header can hold tabs of its own, so the numbers are
+        ## split off the end of the line and the rest is the header pair.
+        idx, rest = line.split("\t", 1)
+        headers, first, second, third = rest.rsplit("\t", 3)
+        if headers == 'fulltext' and len(lines) == 2:
+            ## The fulltext line puts the page range before the word count.
+            sections.append(('fulltext', int(third), int(first), int(second)))
+        else:
+            sections.append((headers, int(first), int(second), int(third)))
+    return int(numberofdivs), int(wordcount), sections
+
+
+class SectionDatabase:
+    '''
+    Opens (creating if necessary) the section database at path. Like the run
+    manifest, volumes are committed in batches of batchsize so the sink costs
+    one disk sync per batch rather than per volume; close() commits the rest.
+    '''
+
+    def __init__(self, path, batchsize=500):
+        self.path = path
+        self.batchsize = batchsize
+        self.pending = 0
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS volumes (
+                                    htid TEXT PRIMARY KEY,
+                                    divs INTEGER NOT NULL,
+                                    wordcount INTEGER NOT NULL,
+                                    pages INTEGER NOT NULL,
+                                    updated REAL)''')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS sections (
+                                    htid TEXT NOT NULL,
+                                    section INTEGER NOT NULL,
+                                    headers TEXT NOT NULL,
+                                    wordcount INTEGER NOT NULL,
+                                    firstpage INTEGER NOT NULL,
+                                    lastpage INTEGER NOT NULL,
+                                    PRIMARY KEY (htid, section))''')
+        self.connection.execute('''CREATE INDEX IF NOT EXISTS sections_headers
+                                    ON sections (headers)''')
+        self.connection.execute('''CREATE INDEX IF NOT EXISTS sections_wordcount
+                                    ON sections (wordcount)''')
+        self.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def record(self, HTid, numberofdivs, wordcount, pages, sections):
+        '''
+        Records the section table of HTid, replacing whatever was recorded for
+        it before. sections is a list of (headers, wordcount, firstpage,
+        lastpage) tuples in section order.
+        '''
+        self.connection.execute("DELETE FROM sections WHERE htid = ?", (HTid,))
+        self.connection.execute(
+            "INSERT OR REPLACE INTO volumes VALUES (?, ?, ?, ?, ?)",
+            (HTid, numberofdivs, wordcount, pages, time.time()))
+        self.connection.executemany(
+            "INSERT INTO sections VALUES (?, ?, ?, ?, ?, ?)",
+            [(HTid, idx) + tuple(section) for idx, section in enumerate(sections)])
+        self.pending += 1
+        if self.pending >= self.batchsize:
+            self.commit()
+
+    def sections(self, HTid):
+        '''Returns the recorded sections of HTid, in order.'''
+        return self.connection.execute(
+            '''SELECT headers, wordcount, firstpage, lastpage FROM sections
+               WHERE htid = ? ORDER BY section''', (HTid,)).fetchall()
+
+    def merge(self, path):
+        '''
+        Copies in the volumes and sections of the database at path, as written
+        by another shard of a run. Where both have recorded an HTid, the more
+        recent record is kept.
+        '''
+        self.commit()
+        self.connection.execute("ATTACH DATABASE ? AS other", (path,))
+        newer = '''SELECT htid FROM other.volumes AS theirs WHERE NOT EXISTS (
+                       SELECT 1 FROM main.volumes AS ours
+                       WHERE ours.htid = theirs.htid AND ours.updated >= theirs.updated)'''
+        try:
+            with self.connection:
+                ## Sections go first, while main.volumes still tells which
+                ## records are newer.
+                self.connection.execute(
+                    "DELETE FROM main.sections WHERE htid IN (" + newer + ")")
+                self.connection.execute(
+                    "INSERT INTO main.sections SELECT * FROM other.sections WHERE htid IN ("
+                    + newer + ")")
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO main.volumes SELECT * FROM other.volumes WHERE htid IN ("
+                    + newer + ")")
+        finally:
+            self.connection.execute("DETACH DATABASE other")
+
+    def commit(self):
+        self.connection.commit()
+        self.pending = 0
+
+    def close(self):
+        self.commit()
+        self.connection.close()
@@ -0,0 +1,217 @@
+'''
+    Packed shard output: collated volumes appended to a few large files
+    instead of a .txt and .meta per volume scattered through the pairtree.
+
+    A ShardStore is a directory of shard files (shard-00000.txt, ...) plus a
+    SQLite index mapping each HTid to the shard holding it, its byte offset
+    and length there, the byte offsets of its sections and the text of its
+    .meta file. Consumers can read a whole volume, or a single <div> section
+    of it, with one seek.
+
+    Every append is synced to disk before its index row is committed, so after
+    a crash the index only lists volumes that were written in full. Opening the
+    store truncates any bytes past the last indexed volume of each shard.
+
+    Volume text is stored uncompressed, so that section offsets stay seekable.
+    Only one bigcollate run should write to a store at a time, though the
+    workers of that run may: each writing process appends to shards of its own.
+    A ShardStore handed to a pool worker unpickles as the one store that
+    process has open for the directory, so a worker keeps appending to the
+    same shard however many jobs it is given.
+'''
+
+import os
+import re
+import sqlite3
+from array import array
+
+## Names of shard files; the number is the shard column of the index.
+shardname = 'shard-{:05d}.txt'
+shardpattern = re.compile(r'^shard-(\d+)\.txt$')
+
+## The store this process writes through, by directory (see _openstore).
+_stores = {}
+
+
+def _openstore(directory, shardbytes):
+    ## Unpickles a ShardStore. Every job handed to a pool worker brings the
+    ## store along, so the worker keeps one per directory rather than
+    ## opening a shard per job. It doesn't recover the store, since other
+    ## processes may be appending to it.
+    key = os.path.abspath(directory)
+    store = _stores.get(key)
+    if store is None:
+        store = ShardStore(directory, shardbytes, recover=False)
+        _stores[key] = store
+    return store
+
+
+class ShardStore:
+    '''
+    Opens (creating if necessary) the shard store in directory. A writing
+    process starts a new shard once the current one would grow past
+    shardbytes.
+
+    The index connection and the open shard are per process: a ShardStore
+    pickles as its directory and shardbytes alone, and unpickles as the
+    store the receiving process already has open there (opening one the
+    first time), so it can be handed to pool workers. recover=False skips
+    the recovery a writer does on opening the store.
+    '''
+
+    def __init__(self, directory, shardbytes=1 << 30, recover=True):
+        self.directory = directory
+        self.shardbytes = shardbytes
+        self._connection = None
+        self._shard = None
+        self._file = None
+        os.makedirs(directory, exist_ok=True)
+        if recover:
+            self.recover()
+
+    def __reduce__(self):
+        return _openstore, (self.directory, self.shardbytes)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(os.path.join(self.directory, 'index.db'),
+                                                timeout=60)
+            self._connection.execute('''CREATE TABLE IF NOT EXISTS volumes (
+                                        htid TEXT PRIMARY KEY,
+                                        shard INTEGER NOT NULL,
+                                        offset INTEGER NOT NULL,
+                                        length INTEGER NOT NULL,
+                                        divs BLOB NOT NULL,
+                                        meta TEXT)''')
+            self._connection.execute('''CREATE INDEX IF NOT EXISTS volumes_shard
+                                        ON volumes (shard)''')
+            self._connection.commit()
+        return self._connection
+
+    def _path(self, shard):
+        return os.path.join(self.directory, shardname.format(shard))
+
+    def recover(self):
+        '''
+        Cuts every shard back to the end of its last indexed volume, dropping
+        whatever a crashed append left behind. Shards left with nothing in
+        them are removed.
+        '''
+        ends = dict(self.connection.execute(
+            "SELECT shard, MAX(offset + length) FROM volumes GROUP BY shard"))
+        for name in os.listdir(self.directory):
+            match = shardpattern.match(name)
+            if match is None:
+                continue
+            shard = int(match.group(1))
+            path = os.path.join(self.directory, name)
+            if shard not in ends:
+                os.remove(path)
+            elif os.path.getsize(path) > ends[shard]:
+                os.truncate(path, ends[shard])
+
+    def _newshard(self):
+        ## Exclusive creation claims the next free number even when several
+        ## workers start new shards at once.
+        if self._file is not None:
+            self._file.close()
+        shard = 0
+        while True:
+            try:
+                handle = os.open(self._path(shard), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+                break
+            except FileExistsError:
+                shard += 1
+        self._shard = shard
+        self._file = os.fdopen(handle, mode='wb')
+
+    def append(self, HTid, data, divs, meta=None):
+        '''
+        Appends the collated text of HTid (as UTF-8 bytes) and indexes it. divs
+        holds the byte offset, within data, at which each section starts. A
+        volume that is already in the store is replaced; its old bytes stay in
+        their shard but are no longer indexed.
+        '''
+        if self._file is None or (self._file.tell() > 0
+                                  and self._file.tell() + len(data) > self.shardbytes):
+            self._newshard()
+        offset = self._file.tell()
+        self._file.write(data)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO volumes VALUES (?, ?, ?, ?, ?, ?)",
+                (HTid, self._shard, offset, len(data),
+                 array('Q', list(divs) + [len(data)]).tobytes(), meta))
+
+    def __contains__(self, HTid):
+        return self.connection.execute(
+            "SELECT 1 FROM volumes WHERE htid = ?", (HTid,)).fetchone() is not None
+
+    def htids(self):
+        '''Returns every indexed HTid, in shard order.'''
+        return [row[0] for row in self.connection.execute(
+                    "SELECT htid FROM volumes ORDER BY shard, offset")]
+
+    def shards(self):
+        '''Returns the numbers of the shards that hold indexed volumes.'''
+        return [row[0] for row in self.connection.execute(
+                    "SELECT DISTINCT shard FROM volumes ORDER BY shard")]
+
+    def locate(self, HTid):
+        '''
+        Returns (shard path, offset, length, boundaries) for HTid, where
+        section k of the volume is bytes boundaries[k] to boundaries[k + 1]
+        of it. Raises KeyError if HTid isn't in the store.
+        '''
+        row = self.connection.execute(
+            "SELECT shard, offset, length, divs FROM volumes WHERE htid = ?",
+            (HTid,)).fetchone()
+        if row is None:
+            raise KeyError(HTid)
+        shard, offset, length, divs = row
+        boundaries = array('Q')
+        boundaries.frombytes(divs)
+        return self._path(shard), offset, length, boundaries
+
+    def _read(self, path, offset, length):
+        with open(path, mode='rb') as file:
+            file.seek(offset)
+            return file.read(length).decode('utf-8')
+
+    def read(self, HTid):
+        '''Returns the collated text of HTid.'''
+        path, offset, length, boundaries = self.locate(HTid)
+        return self._read(path, offset, length)
+
+    def readdiv(self, HTid, idx):
+        '''Returns the text of section idx of HTid.'''
+        path, offset, length, boundaries = self.locate(HTid)
+        if not 0 <= idx < len(boundaries) - 1:
+            raise IndexError("{} has {} sections".format(HTid, len(boundaries) - 1))
+        return self._read(path, offset + boundaries[idx],
+                          boundaries[idx + 1] - boundaries[idx])
+
+    def meta(self, HTid):
+        '''Returns the .meta text stored for HTid, or None if none was stored.'''
+        row = self.connection.execute(
+            "SELECT meta FROM volumes WHERE htid = ?", (HTid,)).fetchone()
+        if row is None:
+            raise KeyError(HTid)
+        return row[0]
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
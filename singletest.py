@@ -2,10 +2,16 @@ from collator3 import collate
 import filekeeping
 from zipfile import ZipFile
 from glob import glob
+import argparse
 
-collectiondir = '/Volumes/obelisk/zipped/serials/'
+parser = argparse.ArgumentParser()
+parser.add_argument('collectiondir', help="root of the pairtree")
+parser.add_argument('HTids', nargs='+')
+args = parser.parse_args()
 
-HTids_to_process = ['mdp.39015065345954']
+collectiondir = args.collectiondir
+
+HTids_to_process = args.HTids
 
 count = 0
 
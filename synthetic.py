@@ -0,0 +1,131 @@
+'''
+    Builds synthetic HathiTrust-style collections for benchmarking.
+
+    Volumes are made of pseudo-random pages with (optionally) alternating verso
+    and recto running headers that change from chapter to chapter, page numbers
+    above or beside the header, OCR noise in the headers, blank pages and stray
+    numeric lines. Each volume is zipped the way HathiTrust ships them (a
+    folder entry followed by one text file per page) and stored in a pairtree
+    under the collection root, with an 'id' file listing the HTids.
+
+    Everything is driven by a seed, so the same arguments always build the
+    same collection.
+'''
+
+import os
+import random
+from zipfile import ZipFile, ZIP_DEFLATED
+
+from .filekeeping import pairtreepath
+
+WORDS = ("the of and to in a is that for it as was with be by on not he this are "
+         "or his from at which but have an they you were her she there been one "
+         "all we their has would when if so no will more out up into do any your "
+         "what some can only other new time could about than my like these people "
+         "society report annual history journal proceedings review natural").split()
+
+ocrconfusions = 'ilI1!.,rnmcoe '
+
+def ocrnoise(text, rng, rate):
+    '''Substitutes or drops characters of text at the given rate.'''
+    if rate <= 0:
+        return text
+    noisy = []
+    for char in text:
+        roll = rng.random()
+        if roll < rate:
+            noisy.append(rng.choice(ocrconfusions))
+        elif roll < rate * 1.3:
+            continue
+        else:
+            noisy.append(char)
+    return ''.join(noisy)
+
+def phrase(rng, shortest, longest):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(shortest, longest)))
+
+def syntheticvolume(seed, pages=200, headers=True, chapters=8, noise=0.05,
+                    blankrate=0.03, lines=30):
+    '''
+    Returns a volume as a list of pages, each a list of lines. headers=False
+    builds a book without running headers. noise is the per-character rate of
+    OCR errors in the headers, blankrate the share of pages that are blank
+    (a few empty lines, or nothing at all), and lines the average number of
+    body lines per page.
+    '''
+    rng = random.Random(seed)
+    title = phrase(rng, 1, 4).upper()
+    chaptertitles = [phrase(rng, 1, 5).upper() for _ in range(max(chapters, 1))]
+    chapterlength = max(pages // max(chapters, 1), 1)
+
+    volume = []
+    for pagenum in range(1, pages + 1):
+        if rng.random() < blankrate:
+            volume.append(['\n'] * rng.randint(0, 6))
+            continue
+
+        page = []
+        if rng.random() < 0.3:
+            page.append(str(pagenum) + '\n')
+        if headers:
+            if pagenum % 2 == 0:
+                header = title
+            else:
+                header = chaptertitles[min((pagenum - 1) // chapterlength, len(chaptertitles) - 1)]
+            header = ocrnoise(header, rng, noise)
+            if rng.random() < 0.5:
+                if pagenum % 2 == 0:
+                    header = str(pagenum) + ' ' + header
+                else:
+                    header = header + ' ' + str(pagenum)
+            page.append(header + '\n')
+        if rng.random() < 0.05:
+            page.append('12 34 5.6\n')
+        for _ in range(rng.randint(lines // 2, lines + lines // 2)):
+            if rng.random() < 0.05:
+                page.append('\n')
+            else:
+                page.append(phrase(rng, 3, 14) + '\n')
+        volume.append(page)
+
+    return volume
+
+def writevolume(volume, HTid, rootpath):
+    '''Zips a volume into its place in the pairtree under rootpath.'''
+    path, postfix = pairtreepath(HTid, rootpath)
+    pagepath = path + postfix + "/"
+    os.makedirs(pagepath, exist_ok=True)
+    with ZipFile(pagepath + postfix + ".zip", mode='w', compression=ZIP_DEFLATED) as zipvol:
+        zipvol.writestr(postfix + "/", "")
+        for idx, page in enumerate(volume):
+            zipvol.writestr(postfix + "/" + "{:08d}.txt".format(idx + 1),
+                            ''.join(page).encode('utf-8'))
+
+def buildcollection(rootpath, count, seed=0, pages=(20, 600), headerless=0.2,
+                    noise=(0.0, 0.15), blankrate=0.03, prefix='syn'):
+    '''
+    Writes count synthetic volumes into a pairtree under rootpath, plus an
+    'id' file listing their HTids, and returns the list of HTids. Page counts
+    and noise rates are drawn uniformly from the given (low, high) ranges, and
+    the share of volumes without running headers is headerless.
+    '''
+    rng = random.Random(seed)
+    os.makedirs(rootpath, exist_ok=True)
+
+    HTids = []
+    for idx in range(count):
+        HTid = "{}.{:08d}".format(prefix, seed * 1000000 + idx)
+        volume = syntheticvolume(rng.randrange(1 << 30),
+                                 pages=rng.randint(pages[0], pages[1]),
+                                 headers=rng.random() >= headerless,
+                                 chapters=rng.randint(1, 20),
+                                 noise=rng.uniform(noise[0], noise[1]),
+                                 blankrate=blankrate)
+        writevolume(volume, HTid, rootpath)
+        HTids.append(HTid)
+
+    with open(os.path.join(rootpath, 'id'), mode='w', encoding='utf-8') as file:
+        for HTid in HTids:
+            file.write(HTid + "\n")
+
+    return HTids
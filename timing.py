@@ -0,0 +1,150 @@
+'''
+    Opt-in per-stage timing for bigcollate runs.
+
+    A StageTimer follows one volume through the pipeline and records the wall
+    time spent in each stage (zip reads, UTF-8 decoding, header extraction,
+    segment(), correctsequence(), the collation loop and file writes) along
+    with page, line and word counts. Stage times are exclusive: when a stage
+    runs inside another (as page reads do inside the write loop when a volume
+    is streamed), its time is counted once, against the inner stage.
+
+    A TimingLog collects the finished records, writes each one as a JSON line,
+    and prints an end-of-run summary with percentiles per stage and the slowest
+    volumes.
+'''
+
+import heapq
+import json
+import time
+from array import array
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def peakmemory():
+    '''
+    Returns the peak resident set size of this process in kilobytes, or None
+    where the resource module isn't available. This is the high-water mark of
+    the whole (worker) process, not of a single volume.
+    '''
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class StageTimer:
+    '''Collects the stage times and counts for one volume.'''
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.counts = {}
+        ## The innermost stage an exception was raised in, if any.
+        self.failed = None
+        ## One entry per open stage: the time spent in stages nested inside it.
+        self._nested = []
+
+    @contextmanager
+    def stage(self, name):
+        '''Times the body of a with block as stage name.'''
+        start = time.perf_counter()
+        self._nested.append(0.0)
+        try:
+            yield
+        except BaseException:
+            self.fail(name)
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            self.stages[name] = self.stages.get(name, 0.0) + elapsed - self._nested.pop()
+            if self._nested:
+                self._nested[-1] += elapsed
+
+    def add(self, name, seconds):
+        '''Adds time measured by the caller to stage name.'''
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+        if self._nested:
+            self._nested[-1] += seconds
+
+    def fail(self, name):
+        '''Notes that the volume failed in stage name, unless a stage inside it already has.'''
+        if self.failed is None:
+            self.failed = name
+
+    def count(self, name, value=1):
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def record(self, **fields):
+        '''Returns the finished record for this volume as a dictionary.'''
+        record = dict(fields)
+        record['wall'] = time.perf_counter() - self.started
+        record['stages'] = self.stages
+        record.update(self.counts)
+        record['peakmemory'] = peakmemory()
+        return record
+
+
+def percentile(values, fraction):
+    '''Nearest-rank percentile of a sorted sequence.'''
+    if len(values) == 0:
+        return 0.0
+    rank = min(int(fraction * len(values)), len(values) - 1)
+    return values[rank]
+
+
+def readlog(path):
+    '''Yields the records of a timing log written by TimingLog, in order.'''
+    with open(path, encoding='utf-8') as file:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+
+class TimingLog:
+    '''
+    Writes timing records to path, one JSON object per line, and keeps what
+    it needs for summary(): every stage time (in compact arrays) and the
+    slowest volumes.
+    '''
+
+    def __init__(self, path, slowest=10):
+        self.file = open(path, mode='a', encoding='utf-8')
+        self.slowest = slowest
+        self.stages = {}
+        self.walls = array('d')
+        self._slowest = []
+
+    def add(self, record):
+        self.file.write(json.dumps(record, sort_keys=True) + "\n")
+        self.walls.append(record['wall'])
+        for name, seconds in record['stages'].items():
+            if name not in self.stages:
+                self.stages[name] = array('d')
+            self.stages[name].append(seconds)
+        entry = (record['wall'], record.get('htid', ''))
+        if len(self._slowest) < self.slowest:
+            heapq.heappush(self._slowest, entry)
+        else:
+            heapq.heappushpop(self._slowest, entry)
+
+    def summary(self):
+        '''Returns the end-of-run summary as a printable string.'''
+        lines = ["{:<18}{:>8}{:>12}{:>10}{:>10}{:>10}{:>10}".format(
+                    'stage', 'volumes', 'total s', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms')]
+        for name, times in [('wall', self.walls)] + sorted(self.stages.items()):
+            ordered = sorted(times)
+            lines.append("{:<18}{:>8}{:>12.2f}{:>10.1f}{:>10.1f}{:>10.1f}{:>10.1f}".format(
+                name, len(ordered), sum(ordered),
+                percentile(ordered, 0.5) * 1000, percentile(ordered, 0.9) * 1000,
+                percentile(ordered, 0.99) * 1000, (ordered[-1] if ordered else 0) * 1000))
+        lines.append("slowest volumes:")
+        for wall, HTid in sorted(self._slowest, reverse=True):
+            lines.append("  {:<40}{:>10.1f} ms".format(HTid, wall * 1000))
+        return "\n".join(lines)
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,147 @@
+'''
+    Per-volume time and memory budgets for bigcollate, and a quarantine list
+    of the volumes that broke them.
+
+    A handful of volumes in a large corpus are pathological: pages of
+    nothing but blank lines, zips whose text isn't valid UTF-8, volumes
+    large enough to exhaust a worker's memory. Without a watchdog one of
+    them fails with whatever error it raises, or holds up its worker for as
+    long as it takes. With one, each volume is collated under a budget. A
+    volume that runs past its time is interrupted (SIGALRM raises
+    VolumeTimeout in the collating thread), one that runs past its memory
+    gets a MemoryError (the budget is an address-space limit on each
+    collating process), and either way the volume is quarantined with the
+    stage it was in and collated once more with errors='replace' decoding,
+    as fixzip.py does by hand, overwriting whatever output the first attempt
+    left. The other volumes carry on as before. Since bigcollate writes a
+    volume's .txt only after its .meta, a volume interrupted mid-write is
+    never taken for a finished one.
+
+    The time budget needs SIGALRM and only applies to volumes collated in
+    the main thread of a process, as pool workers and pipelined runs do; the
+    memory budget needs the resource module. Neither is available on
+    Windows, where the watchdog only quarantines and retries.
+'''
+
+import signal
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+class VolumeTimeout(Exception):
+    '''Raised in the collating thread when a volume runs past its time budget.'''
+
+
+def _expired(signum, frame):
+    raise VolumeTimeout("volume ran past its time budget")
+
+
+def failurereason(err):
+    '''Returns the quarantine reason for an exception: 'time', 'memory' or 'error'.'''
+    if isinstance(err, VolumeTimeout):
+        return 'time'
+    if isinstance(err, MemoryError):
+        return 'memory'
+    ## zlib reports a failed allocation as Z_MEM_ERROR (-4) rather than
+    ## raising MemoryError, which is how a zip read over budget fails.
+    if isinstance(err, zlib.error) and 'Error -4 ' in str(err):
+        return 'memory'
+    return 'error'
+
+
+def describe(err):
+    '''Returns a one-line description of an exception for the quarantine list.'''
+    if str(err) == '':
+        return type(err).__name__
+    return "{}: {}".format(type(err).__name__, err)
+
+
+class Watchdog:
+    '''
+    Budgets for collating one volume: seconds of wall time and megabytes of
+    address space per collating process (None for no limit). A Watchdog
+    holds nothing but its budgets, so it can be handed to pool workers.
+    '''
+
+    def __init__(self, seconds=None, memory=None):
+        self.seconds = seconds
+        self.memory = memory
+
+    def install(self):
+        '''
+        Applies the memory budget to this process; pool workers call this as
+        their initializer. Returns the limits it replaced, for uninstall().
+        '''
+        if self.memory is None or resource is None:
+            return None
+        previous = resource.getrlimit(resource.RLIMIT_AS)
+        limit = self.memory << 20
+        if previous[1] != resource.RLIM_INFINITY:
+            limit = min(limit, previous[1])
+        resource.setrlimit(resource.RLIMIT_AS, (limit, previous[1]))
+        return previous
+
+    def uninstall(self, previous):
+        '''Puts back the limits install() replaced.'''
+        if previous is not None:
+            resource.setrlimit(resource.RLIMIT_AS, previous)
+
+    @contextmanager
+    def budget(self):
+        '''Runs the body of a with block under the time budget.'''
+        if (self.seconds is None or not hasattr(signal, 'setitimer')
+                or threading.current_thread() is not threading.main_thread()):
+            yield
+            return
+        previous = signal.signal(signal.SIGALRM, _expired)
+        signal.setitimer(signal.ITIMER_REAL, self.seconds)
+        try:
+            yield
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous)
+
+
+class Quarantine:
+    '''
+    The quarantine list: a tab-delimited file with one line per volume that
+    failed under the watchdog, appended to as the run goes. Each line holds
+    the HTid, the reason ('time', 'memory' or 'error'), the stage it failed
+    in (see timing.StageTimer), the error, the outcome of the retry and the
+    time it was recorded.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, mode='a', encoding='utf-8')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, HTid, reason, stage, error, outcome):
+        fields = (HTid, reason, stage, error, outcome, repr(time.time()))
+        self.file.write("\t".join(' '.join(str(field).split()) for field in fields) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def quarantined(path):
+    '''Returns the HTids listed in a quarantine file, once each, in order.'''
+    HTids = {}
+    with open(path, encoding='utf-8') as file:
+        for line in file:
+            if line.strip():
+                HTids[line.split("\t", 1)[0]] = True
+    return list(HTids)